@@ -38,10 +38,13 @@ arguments.
 
 import daemon
 from daemon import pidlockfile
+import errno
 import logging
 import optparse
 import os
+import signal
 import sys
+import time
 
 import calypso
 import calypso.webdav as webdav
@@ -88,6 +91,10 @@ parser.add_option(
     "-P", "--pid-file", dest="pidfile",
     default=calypso.config.get("server", "pidfile"),
     help="set location of process-id file")
+parser.add_option(
+    "--processes", type="int",
+    default=calypso.config.getint("server", "processes"),
+    help="number of worker processes to fork, 0 to serve from this one")
     
 (options, args) = parser.parse_args()
 
@@ -129,15 +136,105 @@ if options.import_dest:
     else:
         sys.exit(1)
 
-def run_server():
+def serve(server):
+    """Handle requests on ``server`` until interrupted."""
+    # SIGHUP drops the cached collections, they are read again when used
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: calypso.CollectionHTTPHandler.forget_collections())
     try:
-        # Launch server
-        server_class = calypso.HTTPSServer if options.ssl else calypso.HTTPServer
-        server = server_class(
-            (options.host, options.port), calypso.CollectionHTTPHandler)
         server.serve_forever(poll_interval=10)
     except KeyboardInterrupt:
-        server.socket.close()
+        pass
+    finally:
+        server.server_close()
+
+def serve_worker(server):
+    """Serve from a forked worker process, never returning."""
+    status = 0
+    # The master tells the workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(server)
+    except SystemExit:
+        pass
+    except Exception:
+        log.exception("Worker %d failed", os.getpid())
+        status = 1
+    # Exiting this way skips the atexit handlers, commit what is pending
+    try:
+        calypso.gitrepo.flush()
+    except Exception:
+        log.exception("Worker %d failed to commit its changes", os.getpid())
+        status = 1
+    os._exit(status)
+
+def run_workers(server, count):
+    """Serve from ``count`` forked workers sharing the listening socket.
+
+    Workers that exit are replaced, SIGHUP and SIGTERM are passed on to
+    them. Each worker keeps its own cache of collections, and notices
+    writes from the others through the directory modification times.
+
+    """
+    workers = set()
+    state = {"running": True}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(server)
+        workers.add(pid)
+        # Stopped between the fork and the line above, stop this one too
+        if not state["running"]:
+            os.kill(pid, signal.SIGTERM)
+
+    def forward(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(signum, frame):
+        state["running"] = False
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(count):
+        spawn()
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError, ex:
+            if ex.errno == errno.EINTR:
+                continue
+            raise
+        workers.discard(pid)
+        if state["running"]:
+            log.error("Worker %d exited with status %d, restarting", pid, status)
+            # Do not fork in a tight loop if workers fail on startup
+            time.sleep(1)
+            # A signal during the sleep stops the server, not only it
+            if state["running"]:
+                spawn()
+    server.server_close()
+
+def run_server():
+    # Launch server
+    server_class = calypso.HTTPSServer if options.ssl else calypso.HTTPServer
+    server = server_class(
+        (options.host, options.port), calypso.CollectionHTTPHandler)
+    if options.processes > 0:
+        run_workers(server, options.processes)
+    else:
+        # Stop cleanly, committing the pending changes
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        serve(server)
 
 # If foreground execution is requested, just run the server
 if not options.daemon:
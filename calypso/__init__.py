@@ -37,23 +37,34 @@ should have been included in this package.
 import os
 import os.path
 import base64
+import calendar
+import codecs
+import hashlib
 import socket
 import time
 import email.utils
 import logging
 import rfc822
+import select
 import ssl
+import threading
+import errno
+import zlib
+import ctypes
+import ctypes.util
 
 # Manage Python2/3 different modules
 # pylint: disable=F0401
 try:
     from http import client, server
+    import queue
 except ImportError:
     import httplib as client
     import BaseHTTPServer as server
+    import Queue as queue
 # pylint: enable=F0401
 
-from . import acl, config, webdav, xmlutils, paths
+from . import acl, config, webdav, xmlutils, paths, gitrepo, changelog
 
 log = logging.getLogger()
 ch = logging.StreamHandler()
@@ -63,6 +74,27 @@ log.addHandler(ch)
 
 VERSION = "1.3"
 
+# Precondition failed by a REPORT with a sync token not given by the
+# collection, or too old, read rfc6578-3.2 for info
+INVALID_SYNC_TOKEN = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<D:error xmlns:D="DAV:"><D:valid-sync-token/></D:error>')
+
+class BodyTooLarge(Exception):
+    """Request body larger than the ``max_body_size`` configuration."""
+
+
+def _inflate(data, wbits, limit):
+    """Return ``data`` inflated, raising ``BodyTooLarge`` past ``limit``."""
+    decompressor = zlib.decompressobj(wbits)
+    inflated = decompressor.decompress(data, limit + 1)
+    if len(inflated) > limit or decompressor.unconsumed_tail:
+        raise BodyTooLarge("more than %d bytes once decoded" % limit)
+    inflated += decompressor.flush()
+    if len(inflated) > limit:
+        raise BodyTooLarge("more than %d bytes once decoded" % limit)
+    return inflated
+
+
 def _check(request, function):
     """Check if user has sufficient rights for performing ``request``."""
     # ``_check`` decorator can access ``request`` protected functions
@@ -77,13 +109,30 @@ def _check(request, function):
         user = password = None
 
     owner = None
-    if request._collection:
-        owner = request._collection.owner
+    collection = request._collection
+    if collection:
+        owner = collection.owner
 
     # Also send UNAUTHORIZED if there's no collection. Otherwise one
     # could probe the server for (non-)existing collections.
     if request.server.acl.has_right(owner, user, password):
-        function(request, context={"user": user, "user-agent": request.headers.get("User-Agent", None)})
+        # Compressed bodies are only inflated for authenticated users
+        if not request.decode_body():
+            return
+        context = {"user": user, "user-agent": request.headers.get("User-Agent", None)}
+        if not collection:
+            function(request, context=context)
+        elif request.command in request.writing_methods:
+            # Precondition checks and changes happen atomically
+            with collection.lock.write():
+                collection.scan_dir(False)
+                function(request, context=context)
+        else:
+            # Bring the collection up to date, then read it in parallel
+            # with other readers
+            collection.scan_dir(False)
+            with collection.lock.read():
+                function(request, context=context)
     else:
         request.send_calypso_response(client.UNAUTHORIZED, 0)
         request.send_header(
@@ -93,18 +142,373 @@ def _check(request, function):
     # pylint: enable=W0212
 
 
+class WorkerPool(object):
+    """Bounded pool of threads running jobs for a server.
+
+    At most ``size`` jobs wait in the queue; when it is full, ``submit``
+    blocks the accepting thread and further clients wait in the listen
+    backlog of the server socket.
+
+    """
+
+    def __init__(self, size):
+        """Start ``size`` worker threads."""
+        self.size = size
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.handled = 0
+        self.threads = []
+        for number in range(size):
+            thread = threading.Thread(
+                target=self._run, name="calypso-worker-%d" % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args):
+        """Queue ``function(*args)`` for a worker, waiting for room if needed."""
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            if self.queued > self.size:
+                log.debug("Request queue full: %s", self.stats())
+        self.queue.put((function, args))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            function, args = job
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Worker job failed")
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.handled += 1
+
+    def stats(self):
+        """Return the occupancy counters of the pool."""
+        return {"workers": self.size,
+                "queued": self.queued,
+                "active": self.active,
+                "max_queued": self.max_queued,
+                "handled": self.handled}
+
+    def shutdown(self):
+        """Stop the workers once the queued jobs have been run."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def _libc_sendfile():
+    """Return the ``sendfile`` of the C library, or ``None``."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        position = ctypes.c_int64(offset)
+        sent = function(out_fd, in_fd, ctypes.byref(position), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+    return sendfile
+
+# Copy from file to socket in the kernel, from Python 3.3 or the C library
+_sendfile = getattr(os, "sendfile", None) or _libc_sendfile()
+
+# Bytes read at once from files sent through TLS
+SEND_FILE_CHUNK = 65536
+
+def send_file(connection, file, count):
+    """Send the ``count`` first bytes of ``file`` on ``connection``.
+
+    Data goes through the TLS layer when there is one, read from the file
+    by chunks. Raise ``IOError`` if the file is shorter than ``count``,
+    the answer is then cut short and the connection must be closed.
+
+    """
+    if isinstance(connection, ssl.SSLSocket) or not _sendfile:
+        while count > 0:
+            data = file.read(min(count, SEND_FILE_CHUNK))
+            if not data:
+                raise IOError("File truncated while sent")
+            connection.sendall(data)
+            count -= len(data)
+        return
+    offset = 0
+    timeout = connection.gettimeout()
+    while offset < count:
+        try:
+            sent = _sendfile(connection.fileno(), file.fileno(), offset,
+                             count - offset)
+        except OSError, ex:
+            # Sockets with a timeout are non-blocking
+            if ex.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+            if not select.select([], [connection], [], timeout)[1]:
+                raise socket.timeout("timed out")
+            continue
+        if sent == 0:
+            raise IOError("File truncated while sent")
+        offset += sent
+
+
+class ResponseWriter(object):
+    """Write-only file gathering a response in memory.
+
+    Status line, headers and body are sent together by ``flush``, or
+    once ``size`` bytes are waiting, with a single ``sendall``.
+
+    """
+
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.size = size
+        self.buffer = []
+        self.length = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.length += len(data)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = "".join(self.buffer)
+            self.buffer = []
+            self.length = 0
+            self.connection.sendall(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flush()
+
+
+def _eintr_retry(function, *args):
+    """Call ``function`` again while it is interrupted by a signal."""
+    while True:
+        try:
+            return function(*args)
+        except (OSError, IOError, select.error), ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+
+
+class Poller(object):
+    """Wait for sockets to become readable, with ``epoll`` where available."""
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poll = select.epoll()
+            self._events = select.EPOLLIN
+            self._scale = 1
+        else:
+            self._poll = select.poll()
+            self._events = select.POLLIN
+            self._scale = 1000
+
+    def register(self, fd):
+        self._poll.register(fd, self._events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        """Return the readable file descriptors, waiting at most ``timeout``."""
+        events = _eintr_retry(self._poll.poll, timeout * self._scale)
+        return [fd for fd, _ in events]
+
+
 class HTTPServer(server.HTTPServer):
-    """HTTP server."""
+    """HTTP server.
+
+    With ``workers`` set in the ``server`` configuration section, requests
+    are handled by a ``WorkerPool`` of that many threads instead of the
+    thread accepting connections.
+
+    With ``event_loop`` set, connections waiting for their next request
+    are watched by a single ``Poller`` instead of each holding a thread,
+    and only readable connections are handed to the workers.
+
+    """
     PROTOCOL = "http"
 
     # Maybe a Pylint bug, ``__init__`` calls ``server.HTTPServer.__init__``
     # pylint: disable=W0231
     def __init__(self, address, handler):
         """Create server."""
+        self.request_queue_size = config.getint("server", "backlog")
         server.HTTPServer.__init__(self, address, handler)
         self.acl = acl.load()
+        self.workers = config.getint("server", "workers")
+        self.event_loop = config.getboolean("server", "event_loop")
+        self.pool = None
     # pylint: enable=W0231
 
+    def serve_forever(self, poll_interval=0.5):
+        """Handle requests until shutdown, starting the worker pool first.
+
+        The pool is started here rather than when the server is created,
+        so that forked processes each get their own threads.
+
+        """
+        if self.workers > 0 and not self.pool:
+            self.pool = WorkerPool(self.workers)
+        if self.event_loop:
+            self.serve_events(poll_interval)
+        else:
+            server.HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        """Hand ``request`` to the worker pool, if any."""
+        if self.pool:
+            self.pool.submit(self.process_connection, request, client_address)
+        else:
+            server.HTTPServer.process_request(self, request, client_address)
+
+    def process_connection(self, request, client_address):
+        """Handle every request of a connection, then close it."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def serve_events(self, poll_interval):
+        """Accept connections and watch idle ones from a single thread.
+
+        Each readable connection gets one request handled, by a worker if
+        there is a pool, and then comes back to the loop while it is kept
+        alive. Connections idle for longer than the handler ``timeout``
+        are closed.
+
+        """
+        self._poller = Poller()
+        self._idle = {}
+        self._parked = []
+        self._parked_lock = threading.Lock()
+        wake_read, self._wake_write = os.pipe()
+        # Several processes may poll the same listening socket
+        self.socket.setblocking(0)
+        self._poller.register(self.socket.fileno())
+        self._poller.register(wake_read)
+        timeout = self.RequestHandlerClass.timeout
+        expiry = time.time() + 1
+        while True:
+            for fd in self._poller.poll(min(poll_interval, 1)):
+                if fd == self.socket.fileno():
+                    self._accept_connections()
+                elif fd == wake_read:
+                    _eintr_retry(os.read, wake_read, 4096)
+                    with self._parked_lock:
+                        parked, self._parked = self._parked, []
+                    for handler in parked:
+                        self._idle[handler.connection.fileno()] = (handler, time.time())
+                        self._poller.register(handler.connection.fileno())
+                elif fd in self._idle:
+                    handler, _ = self._idle.pop(fd)
+                    self._poller.unregister(fd)
+                    self._dispatch(handler)
+            now = time.time()
+            if now >= expiry:
+                expiry = now + 1
+                for fd, (handler, since) in self._idle.items():
+                    if now - since > timeout:
+                        log.debug("Closing idle connection from %s", handler.client_address[0])
+                        del self._idle[fd]
+                        self._poller.unregister(fd)
+                        self._close_connection(handler)
+
+    def _accept_connections(self):
+        """Accept every pending connection and watch it for a request."""
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except socket.error, ex:
+                # Nothing left, or another process accepted it first
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not self.verify_request(request, client_address):
+                self.shutdown_request(request)
+                continue
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                continue
+            self._idle[request.fileno()] = (handler, time.time())
+            self._poller.register(request.fileno())
+
+    def _dispatch(self, handler):
+        if self.pool:
+            self.pool.submit(self._handle_one, handler)
+        else:
+            self._handle_one(handler)
+
+    def _handle_one(self, handler):
+        """Handle the next request of ``handler``, then park or close it."""
+        while True:
+            try:
+                handler.handle_one_request()
+                handler.wfile.flush()
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                handler.close_connection = 1
+            if handler.close_connection:
+                self._close_connection(handler)
+                return
+            if not handler.has_buffered_request():
+                break
+        with self._parked_lock:
+            self._parked.append(handler)
+        os.write(self._wake_write, "x")
+
+    def _close_connection(self, handler):
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        self.shutdown_request(handler.request)
+
+    def server_close(self):
+        """Close the listening socket and stop the worker pool."""
+        server.HTTPServer.server_close(self)
+        log.debug("Collections: %s", CollectionHTTPHandler.collections.stats())
+        log.debug("Parsed items: %s", webdav.parsed_cache.stats())
+        if hasattr(self.acl, "stats"):
+            log.debug("Credentials: %s", self.acl.stats())
+        gitrepo.flush()
+        log.debug("Git commits: %s", gitrepo.commit_queue().stats())
+        if self.pool:
+            log.debug("Worker pool: %s", self.pool.stats())
+            self.pool.shutdown()
+            self.pool = None
+
 
 class HTTPSServer(HTTPServer):
     """HTTPS server."""
@@ -139,6 +543,50 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
 
     server_version = "Calypso/%s" % VERSION
 
+    # Bytes written at once when sending a body in parts
+    chunk_size = 65536
+
+    # Largest response gathered before sending, see ResponseWriter
+    wbufsize = 65536
+
+    # Methods changing the collection, they hold its lock exclusively
+    writing_methods = ("DELETE", "PUT")
+
+    def __init__(self, request, client_address, http_server):
+        """Handle the connection, or just prepare it under an event loop.
+
+        Under ``HTTPServer.serve_events`` the server calls
+        ``handle_one_request`` whenever the connection is readable, and
+        ``finish`` once it is closed.
+
+        """
+        if getattr(http_server, "event_loop", False):
+            self.request = request
+            self.client_address = client_address
+            self.server = http_server
+            self.setup()
+        else:
+            server.BaseHTTPRequestHandler.__init__(
+                self, request, client_address, http_server)
+
+    def setup(self):
+        server.BaseHTTPRequestHandler.setup(self)
+        # Whole responses are written at once, no need to wait for more
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wfile = ResponseWriter(self.connection, self.wbufsize)
+
+    def has_buffered_request(self):
+        """Whether data for another request was already read from the socket."""
+        pending = getattr(self.connection, "pending", None)
+        if pending and pending():
+            return True
+        rbuf = getattr(self.rfile, "_rbuf", None)
+        if rbuf is None:
+            return False
+        rbuf.seek(0, 2)
+        return rbuf.tell() > 0
+
     def address_string(self):
         return str(self.client_address[0])
 
@@ -152,6 +600,13 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
         self.send_response(response)
         self.send_connection_header()
         self.send_header("Content-Length", length)
+        self.send_coding_headers()
+
+    def send_coding_headers(self):
+        if self._content_coding:
+            self.send_header("Vary", "Accept-Encoding")
+            if self._content_coding != "identity":
+                self.send_header("Content-Encoding", self._content_coding)
 
     def handle_one_request(self):
         """Handle a single HTTP request.
@@ -182,6 +637,8 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
                 log.error("Connection closed")
                 return
             log.debug("First line '%s'", self.raw_requestline)
+            self._request_collection = None
+            self._content_coding = None
             if not self.parse_request():
                 # An error code has been sent, just exit
                 self.close_connection = 1
@@ -196,6 +653,10 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
                 self.close_connection = 0
             reqlen = self.headers.get('Content-Length',"0")
             log.debug("reqlen %s", reqlen)
+            if int(reqlen) > config.getint("server", "max_body_size"):
+                log.error("Request body too large: %s bytes", reqlen)
+                self.send_error(413)
+                return
             self.xml_request = self.rfile.read(int(reqlen))
             mname = 'do_' + self.command
             if not hasattr(self, mname):
@@ -217,17 +678,41 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             return
 
 
-    collections = {}
+    collections = webdav.CollectionCache()
+
+    _request_collection = None
+
+    # Content coding of the answer: None if the answer can't be
+    # compressed, "identity" if the client did not ask for it
+    _content_coding = None
 
     @property
     def _collection(self):
-        """The ``webdav.Collection`` object corresponding to the given path."""
+        """The ``webdav.Collection`` object corresponding to the given path.
+
+        The same object is returned for the whole request, even if the
+        cache is flushed meanwhile, as the request holds its lock.
+
+        """
+        if self._request_collection is None or self._request_collection[0] != self.path:
+            self._request_collection = (self.path, self._find_collection())
+        return self._request_collection[1]
+
+    def _find_collection(self):
         path = paths.collection_from_path(self.path)
         if not path:
             return None
-        if not path in CollectionHTTPHandler.collections:
-            CollectionHTTPHandler.collections[path] = webdav.Collection(path)
-        return CollectionHTTPHandler.collections[path]
+        return CollectionHTTPHandler.collections.get(path)
+
+    @classmethod
+    def forget_collections(cls):
+        """Drop every cached collection, they are read again when used.
+
+        Safe to call from a signal handler: the cache is replaced, not
+        modified. Collections still in use are kept by the new cache.
+
+        """
+        cls.collections = cls.collections.forget()
 
     def _decode(self, text):
         """Try to decode text according to various parameters."""
@@ -270,14 +755,35 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
 
         self._answer = ''
         answer_text = ''
+        answer_data = None
+        answer_file = None
+        length = None
+        chunks = None
+        utf8 = codecs.lookup(self._encoding).name == "utf-8"
+        sent = False
         try:
             item_name = paths.resource_from_path(self.path)
             if item_name and self._collection:
                 # Get collection item
                 item = self._collection.get_item(item_name)
                 if item:
-                    if is_get:
+                    if utf8:
+                        # Sent from the file when it holds the answer
+                        answer_file = self._collection.open_file(item)
+                    if answer_file is not None:
+                        length = os.fstat(answer_file.fileno()).st_size
+                        if is_get and self.compress_file(length):
+                            answer_data = answer_file.read()
+                            answer_file.close()
+                            answer_file = None
+                            length = None
+                    elif is_get and utf8:
+                        # Already serialized and encoded
+                        answer_data = item.data
+                    elif is_get:
                         answer_text = item.text
+                    elif utf8:
+                        length = item.length
                     etag = item.etag
                 else:
                     self.send_response(client.GONE)
@@ -285,33 +791,259 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
                     self.end_headers()
                     return
             elif self._collection:
-                # Get whole collection
+                # Get whole collection, sent item by item
                 if is_get:
-                    answer_text = self._collection.text
+                    chunks = self._collection.iter_data()
+                    if not utf8:
+                        chunks = (data.decode("utf-8").encode(self._encoding, "xmlcharrefreplace")
+                                  for data in chunks)
                 etag = self._collection.etag
             else:
                 self.send_calypso_response(client.NOT_FOUND, 0)
                 self.end_headers()
                 return
-                
-            if is_get:
-                try:
-                    self._answer = answer_text.encode(self._encoding,"xmlcharrefreplace")
-                except UnicodeDecodeError:
-                    answer_text = answer_text.decode(errors="ignore")
-                    self._answer = answer_text.encode(self._encoding,"ignore")
 
-            self.send_calypso_response(client.OK, len(self._answer))
+            last_modified = self.date_validator(self._collection.last_modified)
+            if self.not_modified(etag, last_modified):
+                self.send_not_modified(etag)
+                return
+
+            chunked = chunks is not None and self.request_version >= "HTTP/1.1"
+            if chunked:
+                chunks = self.compress_chunks(chunks)
+                self.send_response(client.OK)
+                self.send_connection_header()
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_coding_headers()
+            elif chunks is not None:
+                # No chunks for HTTP/1.0 clients, the length is known first
+                if utf8:
+                    length = self._collection.length
+                else:
+                    chunks = list(chunks)
+                    length = sum(len(chunk) for chunk in chunks)
+                self.send_calypso_response(client.OK, length)
+            elif length is not None:
+                # Sent from the file, or only the length for HEAD
+                self.send_calypso_response(client.OK, length)
+            else:
+                if answer_data is not None:
+                    self._answer = answer_data
+                elif is_get:
+                    try:
+                        self._answer = answer_text.encode(self._encoding,"xmlcharrefreplace")
+                    except UnicodeDecodeError:
+                        answer_text = answer_text.decode(errors="ignore")
+                        self._answer = answer_text.encode(self._encoding,"ignore")
+                if is_get:
+                    self._answer = self.compress(self._answer)
+                self.send_calypso_response(client.OK, len(self._answer))
             self.send_header("Content-Type", "text/calendar")
-            self.send_header("Last-Modified", email.utils.formatdate(time.mktime(self._collection.last_modified)))
+            if last_modified is not None:
+                self.send_header("Last-Modified", email.utils.formatdate(last_modified))
             self.send_header("ETag", etag)
             self.end_headers()
-            if is_get:
+            sent = True
+            if chunks is not None:
+                self.write_chunks(chunks, chunked)
+            elif answer_file is not None and is_get:
+                self.wfile.flush()
+                send_file(self.connection, answer_file, length)
+            elif is_get:
                 self.wfile.write(self._answer)
         except Exception:
             log.exception("Failed HEAD for %s", self.path)
+            if sent:
+                # Too late for an error status, the body is cut short
+                self.close_connection = 1
+                return
             self.send_calypso_response(client.BAD_REQUEST, 0)
             self.end_headers()
+        finally:
+            if answer_file is not None:
+                answer_file.close()
+
+    def accepted_coding(self):
+        """Return the compression accepted by the client, or ``None``."""
+        accepted = {}
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            quality = 1.0
+            params = params.strip().replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0
+            accepted[name.strip().lower()] = quality
+        for name in ("gzip", "deflate"):
+            if accepted.get(name, accepted.get("*", 0)) > 0:
+                return name
+        return None
+
+    def compressor(self):
+        """Return a compression object for the accepted coding, or ``None``.
+
+        Also sets the content coding sent with the answer.
+
+        """
+        if not config.getboolean("server", "compression"):
+            return None
+        coding = self.accepted_coding()
+        self._content_coding = coding or "identity"
+        if not coding:
+            return None
+        level = config.getint("server", "compression_level")
+        # gzip is deflate with a gzip header, deflate has a zlib header
+        wbits = zlib.MAX_WBITS + 16 if coding == "gzip" else zlib.MAX_WBITS
+        return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        """Return ``data``, compressed if large enough and accepted."""
+        if len(data) < config.getint("server", "compression_threshold"):
+            return data
+        compressor = self.compressor()
+        if not compressor:
+            return data
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_file(self, length):
+        """Whether a file of ``length`` bytes is to be sent compressed."""
+        return length >= config.getint("server", "compression_threshold") \
+            and self.compressor() is not None
+
+    def compress_chunks(self, chunks):
+        """Return the strings of ``chunks``, compressed if accepted."""
+        compressor = self.compressor()
+        if not compressor:
+            return chunks
+        return self._compressed(chunks, compressor)
+
+    @staticmethod
+    def _compressed(chunks, compressor):
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decode_body(self):
+        """Decode the request body from its content coding, if any.
+
+        Return False after answering the request if the body cannot be
+        decoded: 415 for an unsupported coding, 400 for a corrupt body and
+        413 for a body larger than ``max_body_size`` once decoded.
+
+        """
+        coding = self.headers.get("Content-Encoding", "identity").strip().lower()
+        if coding == "identity":
+            return True
+        try:
+            self.xml_request = self.decompress(
+                self.xml_request, coding,
+                config.getint("server", "max_body_size"))
+            return True
+        except BodyTooLarge, ex:
+            log.error("Request body too large: %s", ex)
+            code = client.REQUEST_ENTITY_TOO_LARGE
+        except zlib.error, ex:
+            log.error("Cannot decode request body: %s", ex)
+            code = client.BAD_REQUEST
+        except ValueError, ex:
+            log.error("Cannot decode request body: %s", ex)
+            code = client.UNSUPPORTED_MEDIA_TYPE
+        self.close_connection = 1
+        self.send_error(code)
+        return False
+
+    @staticmethod
+    def decompress(data, coding, limit):
+        """Return request body ``data`` decoded from ``coding``.
+
+        Raise ``BodyTooLarge`` if it decodes to more than ``limit`` bytes,
+        without decoding more than that.
+
+        """
+        if coding in ("gzip", "x-gzip"):
+            return _inflate(data, zlib.MAX_WBITS + 16, limit)
+        if coding == "deflate":
+            try:
+                return _inflate(data, zlib.MAX_WBITS, limit)
+            except zlib.error:
+                # Some clients send raw deflate data, without zlib header
+                return _inflate(data, -zlib.MAX_WBITS, limit)
+        raise ValueError("Unsupported content coding %r" % coding)
+
+    def date_validator(self, last_modified):
+        """Return ``last_modified``, a UTC time tuple, in seconds since the
+        epoch, or None if it is too recent to tell copies apart.
+
+        Dates only have whole seconds: a change in the same second as the
+        answer would keep its date, and If-Modified-Since would then wrongly
+        accept the older copy.
+
+        """
+        seconds = calendar.timegm(last_modified)
+        if time.time() - seconds < 1:
+            return None
+        return seconds
+
+    def not_modified(self, etag, last_modified):
+        """Whether the request is conditional and its copy is still valid.
+
+        ``etag`` and ``last_modified``, in seconds since the epoch, are
+        checked against If-None-Match or, without it, If-Modified-Since.
+        ``last_modified`` is None when the date cannot be used.
+
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag == "*" or rfc822.unquote(tag) == etag:
+                    return True
+            return False
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and last_modified is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date:
+                return int(last_modified) <= email.utils.mktime_tz(date)
+        return False
+
+    def send_not_modified(self, etag):
+        """Answer 304 (Not Modified), without body."""
+        self.send_response(client.NOT_MODIFIED)
+        self.send_connection_header()
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def write_chunks(self, chunks, chunked):
+        """Write the strings of ``chunks`` as the response body.
+
+        Small strings are grouped to write about ``chunk_size`` bytes at
+        once, in the chunked transfer coding if ``chunked`` is true.
+
+        """
+        group = []
+        size = 0
+        for chunk in chunks:
+            group.append(chunk)
+            size += len(chunk)
+            if size >= self.chunk_size:
+                self._write_chunk("".join(group), chunked)
+                group = []
+                size = 0
+        if size:
+            self._write_chunk("".join(group), chunked)
+        if chunked:
+            self.wfile.write("0\r\n\r\n")
+
+    def _write_chunk(self, data, chunked):
+        if chunked:
+            data = "%x\r\n%s\r\n" % (len(data), data)
+        self.wfile.write(data)
 
     def if_match(self, item):
         header = self.headers.get("If-Match", item.etag)
@@ -372,14 +1104,27 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
         try:
             xml_request = self.xml_request
             log.debug("PROPFIND %s", xml_request)
+            depth = self.headers.get("depth", "infinity")
+            etag = None
+            if self._collection:
+                # The answer changes with the resource and the request:
+                # only the ETag tells them apart, dates are not validators
+                item_name = paths.resource_from_path(self.path)
+                resource = item_name and self._collection.get_item(item_name) or self._collection
+                etag = hashlib.sha1("%s %s %s" % (resource.etag, depth, xml_request)).hexdigest()
+                if self.not_modified(etag, None):
+                    self.send_not_modified(etag)
+                    return
             self._answer = xmlutils.propfind(
-                self.path, xml_request, self._collection,
-                self.headers.get("depth", "infinity"))
+                self.path, xml_request, self._collection, depth)
             log.debug("PROPFIND ANSWER %s", self._answer)
+            self._answer = self.compress(self._answer)
 
             self.send_calypso_response(client.MULTI_STATUS, len(self._answer))
             self.send_header("DAV", "1, calendar-access")
             self.send_header("Content-Type", "text/xml")
+            if etag:
+                self.send_header("ETag", etag)
             self.end_headers()
             self.wfile.write(self._answer)
         except Exception:
@@ -441,10 +1186,18 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             log.debug("REPORT %s %s", self.path, xml_request)
             self._answer = xmlutils.report(self.path, xml_request, self._collection)
             log.debug("REPORT ANSWER %s", self._answer)
+            self._answer = self.compress(self._answer)
             self.send_calypso_response(client.MULTI_STATUS, len(self._answer))
             self.send_header("Content-Type", "text/xml")
             self.end_headers()
             self.wfile.write(self._answer)
+        except changelog.InvalidSyncToken, ex:
+            log.info("Invalid sync token for %s: %s", self.path, ex)
+            self._answer = INVALID_SYNC_TOKEN
+            self.send_calypso_response(client.FORBIDDEN, len(self._answer))
+            self.send_header("Content-Type", "text/xml")
+            self.end_headers()
+            self.wfile.write(self._answer)
         except Exception:
             log.exception("Failed REPORT for %s", self.path)
             self.send_calypso_response(client.BAD_REQUEST, 0)
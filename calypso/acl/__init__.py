@@ -26,11 +26,96 @@ configuration.
 
 """
 
+import hashlib
+import hmac
+import os
+import threading
+import time
+
 from calypso import config
 
+_SALT = os.urandom(16)
+
+
+def password_digest(password):
+    """Return a digest of ``password`` salted with a secret of the process."""
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    return hmac.new(_SALT, password, hashlib.sha256).digest()
+
+
+class CredentialCache(object):
+    """Remember the credentials accepted by an ACL manager for a while.
+
+    Entries are keyed by owner, user and ``password_digest``, so that the
+    passwords themselves are not kept. Managers may define a ``stamp``
+    function returning a value that changes with their users, such as the
+    modification time of the password file: the whole cache is then
+    dropped when it changes.
+
+    """
+    max_entries = 4096
+
+    def __init__(self, manager, ttl):
+        self.manager = manager
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stamp = None
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self):
+        """Drop all the entries if the users of the manager changed."""
+        stamp = self.manager.stamp() if hasattr(self.manager, "stamp") else None
+        if stamp != self.stamp:
+            self.entries.clear()
+            self.stamp = stamp
+
+    def has_right(self, owner, user, password):
+        """Check if ``user``/``password`` couple is valid."""
+        if user is None or password is None:
+            return self.manager.has_right(owner, user, password)
+        key = owner, user, password_digest(password)
+        now = time.time()
+        with self.lock:
+            self._current()
+            expiry = self.entries.get(key)
+            if expiry is not None and expiry > now:
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not self.manager.has_right(owner, user, password):
+            return False
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                for old_key, expiry in self.entries.items():
+                    if expiry <= now:
+                        del self.entries[old_key]
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+            self.entries[key] = now + self.ttl
+        return True
+
+    def stats(self):
+        """Return the occupancy and hit counters of the cache."""
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses}
+
 
 def load():
-    """Load list of available ACL managers."""
+    """Load list of available ACL managers.
+
+    Unless disabled with ``cache_ttl`` set to 0, the manager is wrapped in
+    a ``CredentialCache``.
+
+    """
     acl_type = config.get("acl", "type").encode("utf-8")
     module = __import__("calypso.acl", fromlist=[acl_type])
-    return getattr(module, acl_type)
+    manager = getattr(module, acl_type)
+    ttl = config.getint("acl", "cache_ttl")
+    if ttl > 0 and acl_type != "fake":
+        return CredentialCache(manager, ttl)
+    return manager
@@ -25,12 +25,15 @@ Load the list of login/password couples according a the configuration file
 created by Apache ``htpasswd`` command. Plain-text, crypt and sha1 are
 supported, but md5 is not (see ``htpasswd`` man page to understand why).
 
+The file is read once, and again only when it changes.
+
 """
 
 import base64
 import hashlib
-import os.path
+import os
 import logging
+import threading
 
 from calypso import config
 
@@ -57,17 +60,64 @@ def _sha1(hash_value, password):
     return sha1.digest() == base64.b64decode(hash_value)
 
 
+def stamp():
+    """Return a value changing with the content of the password file."""
+    try:
+        stat = os.stat(FILENAME)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_ino, stat.st_size
+
+
+def _load():
+    """Read the password file into a dictionary of hashes by login."""
+    users = {}
+    try:
+        lines = open(FILENAME).readlines()
+    except IOError, ex:
+        log.error("Cannot read password file %s: %s", FILENAME, ex)
+        return users
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if ":" not in line:
+            log.warning("Ignoring malformed line %d of %s", number, FILENAME)
+            continue
+        login, hash_value = line.split(":", 1)
+        if login in users:
+            log.warning("Ignoring duplicate user %s on line %d of %s",
+                        login, number, FILENAME)
+            continue
+        users[login] = hash_value
+    log.debug("Loaded %d users from %s", len(users), FILENAME)
+    return users
+
+
+def _users():
+    """Return the users of the password file, reading it if it changed."""
+    global _USERS, _STAMP
+    current = stamp()
+    with _LOCK:
+        if _USERS is None or current != _STAMP:
+            _USERS = _load()
+            _STAMP = current
+        return _USERS
+
+
 def has_right(owner, user, password):
     """Check if ``user``/``password`` couple is valid."""
     log.debug("owner %s user %s", owner, user)
-    for line in open(FILENAME).readlines():
-        if line.strip():
-            login, hash_value = line.strip().split(":", 1)
-            if login == user and (not PERSONAL or user == owner):
-                return CHECK_PASSWORD(hash_value, password)
+    hash_value = _users().get(user)
+    if hash_value is not None and (not PERSONAL or user == owner):
+        return CHECK_PASSWORD(hash_value, password)
     return False
 
 
 FILENAME = os.path.expanduser(config.get("acl", "filename"))
 PERSONAL = config.getboolean("acl", "personal")
 CHECK_PASSWORD = locals()["_%s" % config.get("acl", "encryption")]
+
+_LOCK = threading.Lock()
+_USERS = None
+_STAMP = None
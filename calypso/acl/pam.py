@@ -20,24 +20,32 @@
 PAM authentication
 
 Use Pluggable Authentication Modules (PAM) system on Linux
-for checking users/passwords.
+for checking users/passwords. The checks run in a small pool of threads,
+so that a slow PAM stack does not hold the requests of other users.
 
 """
 
 import logging
+import Queue
+import threading
+import time
+
 import PAM
 
 from calypso import config
+from calypso.acl import password_digest
+from calypso.utils import per_process
 
 LOG = logging.getLogger()
 SVC = config.get("acl", "pam_service")
 PERSONAL = config.getboolean("acl", "personal")
+WORKERS = config.getint("acl", "pam_workers")
+TIMEOUT = config.getfloat("acl", "pam_timeout")
+FAILURE_TTL = config.getint("acl", "pam_failure_ttl")
 
-def has_right(owner, user, password):
-    """Check if ``user``/``password`` couple is valid."""
-    LOG.debug("owner %s user %s", owner, user)
-    if owner and owner != user and PERSONAL:
-        return False
+
+def _authenticate(user, password):
+    """Ask PAM if ``user``/``password`` couple is valid."""
     def pam_conv(auth, query_list, userData):
         result = []
         result.append((password, 0))
@@ -54,4 +62,111 @@ def has_right(owner, user, password):
         LOG.debug('PAM error: %s', resp)
     return False
 
+
+class _Check(object):
+    """PAM check of a user/password couple, run by a worker."""
+
+    def __init__(self, user, password):
+        self.user = user
+        self.password = password
+        self.result = False
+        self.done = threading.Event()
+
+
+class Authenticator(object):
+    """Bounded pool of threads running the PAM checks.
+
+    PAM modules may sleep after a wrong password (``pam_faildelay``) or
+    wait for slow name services: the checks run in the threads of the
+    pool, and the requests give up waiting for them after ``timeout``
+    seconds. Concurrent checks of the same credentials share one PAM call,
+    and refused credentials are refused again without asking PAM for
+    ``failure_ttl`` seconds. When ``size`` checks are already waiting for
+    a worker, new ones are refused.
+
+    """
+    max_failures = 4096
+
+    def __init__(self, size, timeout, failure_ttl):
+        """Start ``size`` worker threads."""
+        self.timeout = timeout
+        self.failure_ttl = failure_ttl
+        self.queue = Queue.Queue(size)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failures = {}
+        for number in range(size):
+            thread = threading.Thread(
+                target=self._run, name="calypso-pam-%d" % number)
+            thread.daemon = True
+            thread.start()
+
+    def check(self, user, password):
+        """Check if ``user``/``password`` couple is valid."""
+        key = user, password_digest(password)
+        with self.lock:
+            expiry = self.failures.get(key)
+            if expiry is not None:
+                if expiry > time.time():
+                    LOG.debug("Recently refused credentials for %s", user)
+                    return False
+                del self.failures[key]
+            check = self.pending.get(key)
+            if check is None:
+                check = _Check(user, password)
+                try:
+                    self.queue.put_nowait((key, check))
+                except Queue.Full:
+                    LOG.warning("Too many PAM checks waiting, refusing %s",
+                                user)
+                    return False
+                self.pending[key] = check
+        if not check.done.wait(self.timeout):
+            LOG.warning("PAM check for %s timed out", user)
+            return False
+        return check.result
+
+    def _refused(self, key):
+        """Remember that the credentials of ``key`` were refused."""
+        now = time.time()
+        if len(self.failures) >= self.max_failures:
+            for old_key, expiry in self.failures.items():
+                if expiry <= now:
+                    del self.failures[old_key]
+            if len(self.failures) >= self.max_failures:
+                self.failures.clear()
+        self.failures[key] = now + self.failure_ttl
+
+    def _run(self):
+        while True:
+            key, check = self.queue.get()
+            refused = False
+            try:
+                check.result = _authenticate(check.user, check.password)
+                refused = not check.result
+            except Exception:
+                LOG.exception("PAM check failed")
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                    if refused and self.failure_ttl > 0:
+                        self._refused(key)
+                check.done.set()
+
+
+@per_process
+def authenticator():
+    """Return the ``Authenticator`` of this process."""
+    return Authenticator(max(WORKERS, 1), TIMEOUT, FAILURE_TTL)
+
+
+def has_right(owner, user, password):
+    """Check if ``user``/``password`` couple is valid."""
+    LOG.debug("owner %s user %s", owner, user)
+    if owner and owner != user and PERSONAL:
+        return False
+    if user is None or password is None:
+        return False
+    return authenticator().check(user, password)
+
 # vi: set ts=4 sw=4 et si :
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Change logs of the collections.
+
+Each collection directory has a hidden file listing, in order, the names
+of the items written or removed with their new ETag, so that clients can
+ask for what changed since they last synchronized (RFC 6578). A position
+in the log is the size of the file when it was read, the sync tokens
+given to clients are made from it and from the identifier written at the
+start of the log, which changes when the log is started again.
+
+"""
+
+import binascii
+import errno
+import fcntl
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# Hidden file of each collection directory logging the changes
+CHANGES_NAME = ".calypso-changes"
+HEADER = "calypso-changes 1 %s\n"
+TOKEN_PREFIX = "http://calypso/ns/sync/"
+
+_MISSING = object()
+
+
+class InvalidSyncToken(Exception):
+    """Sync token not given by this log, or too old."""
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class ChangeLog(object):
+    """Append-only log of the changes of the items of a collection.
+
+    Processes sharing the collection append under an exclusive ``flock``
+    of the file. Each change is logged once: the last logged ETag of each
+    item is kept, and changes giving an item the ETag it already has in
+    the log, as when a scan finds a file written by another process, are
+    not logged again. When the log grows over ``max_size``, it is started
+    again with a new identifier, and older sync tokens become invalid.
+
+    """
+    max_size = 8 * 1024 * 1024
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, CHANGES_NAME)
+        # Identifier and inode of the log, last read
+        self.id = None
+        self.inode = None
+        # Last ETag of each item, up to ``read_offset`` of the log
+        self.logged = {}
+        self.read_offset = 0
+
+    def _open(self):
+        """Open the log locked, creating or starting it again if needed."""
+        while True:
+            file = open(self.path, "a+")
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            st = os.fstat(file.fileno())
+            try:
+                current = os.stat(self.path)
+            except OSError:
+                current = None
+            if current and current.st_ino == st.st_ino:
+                break
+            # Replaced by another process meanwhile
+            file.close()
+        if st.st_size == 0:
+            file.write(HEADER % binascii.hexlify(os.urandom(8)))
+            file.flush()
+            st = os.fstat(file.fileno())
+        self._adopt(file, st)
+        return file
+
+    def _adopt(self, file, st):
+        """Read the identifier of ``file`` if it is not the last log read."""
+        if st.st_ino != self.inode:
+            file.seek(0)
+            self.id = file.readline().split()[2]
+            self.inode = st.st_ino
+            self.logged = {}
+            self.read_offset = file.tell()
+
+    def _restart(self, file):
+        """Replace the log by a new one, ``file`` being the locked log."""
+        temp = self.path + ".new"
+        with open(temp, "w") as new_file:
+            new_file.write(HEADER % binascii.hexlify(os.urandom(8)))
+        os.rename(temp, self.path)
+        file.close()
+        return self._open()
+
+    def _read(self, file, offset, end):
+        """Return the changes between ``offset`` and ``end`` of ``file``."""
+        file.seek(offset)
+        data = file.read(end - offset)
+        changes = []
+        for line in data.splitlines():
+            try:
+                name, etag = json.loads(line)
+            except (ValueError, TypeError):
+                log.warning("Ignoring malformed line in %s", self.path)
+                continue
+            changes.append((_utf8(name), etag and str(etag)))
+        return changes
+
+    def position(self):
+        """Return the identifier and the end offset of the log."""
+        try:
+            file = open(self.path)
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            file = self._open()
+        else:
+            # Appends are complete once the lock is granted
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH)
+        try:
+            st = os.fstat(file.fileno())
+            self._adopt(file, st)
+            return self.id, st.st_size
+        finally:
+            file.close()
+
+    def is_at(self, position):
+        """Whether the log still ends at ``position``, checked by a stat."""
+        if position is None:
+            return False
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino == self.inode and position[0] == self.id and
+                st.st_size == position[1])
+
+    def record(self, changes, complete=False):
+        """Log ``changes``, a list of names and ETags, ``None`` if removed.
+
+        If ``complete``, ``changes`` lists every item, and the items of
+        the log missing from it are logged as removed.
+
+        Return the positions before and after the changes were logged.
+
+        """
+        file = self._open()
+        try:
+            end = os.fstat(file.fileno()).st_size
+            if end > self.max_size:
+                log.info("Starting %s again", self.path)
+                file = self._restart(file)
+                end = os.fstat(file.fileno()).st_size
+            for name, etag in self._read(file, self.read_offset, end):
+                self.logged[name] = etag
+            changes = [(_utf8(name), etag) for name, etag in changes]
+            if complete:
+                names = set(name for name, etag in changes)
+                changes.extend((name, None) for name, etag
+                               in self.logged.items()
+                               if etag and name not in names)
+            lines = []
+            for name, etag in changes:
+                if self.logged.get(name, _MISSING) != etag:
+                    self.logged[name] = etag
+                    lines.append(json.dumps([name, etag]) + "\n")
+            if lines:
+                file.seek(0, os.SEEK_END)
+                file.write("".join(lines))
+                file.flush()
+            self.read_offset = os.fstat(file.fileno()).st_size
+            return (self.id, end), (self.id, self.read_offset)
+        finally:
+            file.close()
+
+    def token(self, position):
+        """Return the sync token of ``position``."""
+        return "%s%s-%d" % (TOKEN_PREFIX, position[0], position[1])
+
+    def since(self, token, position):
+        """Return the last ETag of the items changed after ``token``.
+
+        Only the changes before ``position`` are read. Raise
+        ``InvalidSyncToken`` if the token was not given by this log.
+
+        """
+        log_id, end = position
+        try:
+            if not token.startswith(TOKEN_PREFIX):
+                raise ValueError(token)
+            token_id, offset = token[len(TOKEN_PREFIX):].rsplit("-", 1)
+            offset = int(offset)
+        except ValueError:
+            raise InvalidSyncToken(token)
+        if token_id != log_id:
+            raise InvalidSyncToken(token)
+        changes = {}
+        if offset == end:
+            return changes
+        # A token past ``end`` may come from a process further in the log
+        with open(self.path) as file:
+            header = file.readline()
+            if offset < len(header) or header.split()[2] != log_id:
+                raise InvalidSyncToken(token)
+            file.seek(offset - 1)
+            if file.read(1) != "\n":
+                raise InvalidSyncToken(token)
+            if offset > end:
+                return changes
+            for name, etag in self._read(file, offset, end):
+                changes[name] = etag
+        return changes
@@ -46,6 +46,14 @@ INITIAL_CONFIG = {
         "certificate": "/etc/apache2/ssl/server.crt",
         "key": "/etc/apache2/ssl/server.key",
         "pidfile": "/var/run/calypso.pid",
+        "workers": "0",
+        "backlog": "5",
+        "processes": "0",
+        "event_loop": "False",
+        "compression": "True",
+        "compression_threshold": "1024",
+        "compression_level": "6",
+        "max_body_size": "10485760",
     },
     "encoding": {
         "request": "utf-8",
@@ -56,9 +64,21 @@ INITIAL_CONFIG = {
         "filename": "/etc/calypso/users",
         "encryption": "crypt",
         "pam_service": "passwd",
+        "pam_workers": "2",
+        "pam_timeout": "10",
+        "pam_failure_ttl": "30",
+        "cache_ttl": "300",
     },
     "storage": {
-        "folder": os.path.expanduser("~/.config/calypso/calendars")}}
+        "folder": os.path.expanduser("~/.config/calypso/calendars"),
+        "inotify": "False",
+        "index": "True",
+        "parsed_cache_mb": "64",
+        "cached_collections": "1000",
+        "collection_idle": "3600",
+        "git_commit_window": "1",
+        "git_fast_import": "False",
+        "change_log": "True"}}
 
 # Create a ConfigParser and configure it
 _CONFIG_PARSER = ConfigParser()
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Git history of the collections.
+
+Changed files are recorded in the git repository of their collection by
+a thread of the process, some time after the change: the changes made in
+the meantime are committed together, instead of running git for each one
+while the client waits. Optionally, the commits are written by a running
+``git fast-import`` instead of new git processes.
+
+"""
+
+import atexit
+import calendar
+import collections
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from . import config
+from .utils import per_process
+
+log = logging.getLogger(__name__)
+
+
+def change_message(context):
+    """Return the message of the change described by ``context``."""
+    message = context.get('action', 'other action')
+    if "user-agent" in context:
+        message += u"\n\nUser-Agent: %r" % context['user-agent']
+    return message
+
+
+def commit_message(contexts):
+    """Return the commit message of the changes described by ``contexts``."""
+    messages = [change_message(context) for context in contexts]
+    if len(messages) == 1:
+        return messages[0]
+    return u"%d changes\n\n" % len(messages) + u"\n\n".join(messages)
+
+
+def author(context):
+    """Return the author name and email of ``context``, or ``None``."""
+    if "user" not in context:
+        return None
+    return context['user'] or "unknown", "%s@webdav"%context['user']
+
+
+def commit(path, names, contexts):
+    """Commit the current state of files ``names`` of repository ``path``.
+
+    The author is the user of the first context, the message lists the
+    changes of all the contexts.
+
+    """
+    present = [name for name in names
+               if os.path.exists(os.path.join(path, name))]
+    missing = [name for name in names if name not in present]
+    if present:
+        subprocess.check_call(["git", "add", "--"] + present, cwd=path)
+    if missing:
+        subprocess.check_call(
+            ["git", "rm", "--cached", "--ignore-unmatch", "-q", "--"] + missing,
+            cwd=path)
+
+    args = ["git", "commit", "--allow-empty"]
+    env = {}
+
+    identity = author(contexts[0])
+    if identity:
+        # use environment variables instead of --author to avoid git
+        # looking it up in previous commits if it doesn't seem well-formed
+        env['GIT_AUTHOR_NAME'], env['GIT_AUTHOR_EMAIL'] = identity
+        # supress a chatty message that we could configure author
+        # information explicitly in the config file. (slicing it in after
+        # the git command as position is important with git arguments)
+        args[1:1] = ["-c", "advice.implicitIdentity=false"]
+
+    args.extend(["-m", commit_message(contexts).encode('utf8')])
+
+    subprocess.check_call(args, cwd=path, env=env)
+
+
+# Patterns known to be in the exclude file of each git directory
+_excluded = set()
+_excluded_lock = threading.Lock()
+
+def exclude(path, pattern):
+    """Keep the files matching ``pattern`` out of the git status of ``path``.
+
+    The pattern is added to the ``info/exclude`` file of the repository
+    of directory ``path``, if any, so that files the server keeps next to
+    the items are neither shown as untracked nor added by ``git add -A``.
+
+    """
+    directory = os.path.abspath(path)
+    while not os.path.isdir(os.path.join(directory, ".git")):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return
+        directory = parent
+    exclude_path = os.path.join(directory, ".git", "info", "exclude")
+    with _excluded_lock:
+        if (exclude_path, pattern) in _excluded:
+            return
+        try:
+            try:
+                with open(exclude_path) as exclude_file:
+                    patterns = exclude_file.read()
+            except IOError:
+                patterns = ""
+            if pattern not in patterns.splitlines():
+                if not os.path.isdir(os.path.dirname(exclude_path)):
+                    os.makedirs(os.path.dirname(exclude_path))
+                with open(exclude_path, "a") as exclude_file:
+                    if patterns and not patterns.endswith("\n"):
+                        exclude_file.write("\n")
+                    exclude_file.write(pattern + "\n")
+        except (IOError, OSError), ex:
+            log.warning("Cannot exclude %s from git in %s: %s",
+                        pattern, directory, ex)
+            return
+        _excluded.add((exclude_path, pattern))
+
+
+def _ident_part(value):
+    """Encode ``value`` for an identity, without the characters git drops."""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return re.sub(r"[<>\n]", "", value).strip()
+
+
+def _timestamp(now):
+    """Return ``now`` in the ``<seconds> <offset>`` format of git."""
+    offset = (calendar.timegm(time.localtime(now)) - int(now)) // 60
+    sign = "-" if offset < 0 else "+"
+    return "%d %s%02d%02d" % (now, sign, abs(offset) // 60, abs(offset) % 60)
+
+
+def _cleanup(message):
+    """Clean up ``message`` the way ``git commit -m`` does."""
+    lines = [line.rstrip() for line in message.strip().split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)) + "\n"
+
+
+class FastImport(object):
+    """Long-running ``git fast-import`` process committing to a repository.
+
+    Commits are written to the current branch of the repository without
+    running git for each one: the files are sent to the process, which
+    stores them and builds the trees and the commit, then updates the
+    branch at a checkpoint. The commits are the ones ``commit`` makes,
+    with the same author, committer and message. Each one starts from the
+    branch as found in the repository, so that commits made meanwhile by
+    other processes are kept; if the branch moved during the checkpoint,
+    ``commit`` raises ``FastImportError`` and nothing was lost.
+
+    The index of the repository is not updated for each commit, it is
+    reset to the branch when the process is closed.
+
+    """
+
+    def __init__(self, path):
+        """Start ``git fast-import`` for the repository of ``path``."""
+        self.path = path
+        git = lambda *args: subprocess.check_output(
+            ("git",) + args, cwd=path, env={}).strip()
+        self.branch = git("symbolic-ref", "HEAD")
+        self.git_dir = os.path.join(path, git("rev-parse", "--git-dir"))
+        self.prefix = git("rev-parse", "--show-prefix")
+        self.committer = re.sub(
+            r"\s+\d+ [-+]\d{4}$", "", git("var", "GIT_COMMITTER_IDENT"))
+        self.started = subprocess.call(
+            ["git", "rev-parse", "-q", "--verify", self.branch],
+            cwd=path, stdout=open(os.devnull, "w")) == 0
+        # Repair the index left by a process that was not closed
+        if self.started:
+            subprocess.check_call(["git", "reset", "-q"], cwd=path)
+        self.process = subprocess.Popen(
+            ["git", "fast-import", "--quiet", "--done"], cwd=path, env={},
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.mark = 0
+        self.commits = 0
+
+    def _ref(self):
+        """Return the commit of the branch, read from the repository."""
+        try:
+            return open(os.path.join(self.git_dir, self.branch)).read().strip()
+        except IOError:
+            pass
+        try:
+            for line in open(os.path.join(self.git_dir, "packed-refs")):
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == self.branch:
+                    return fields[0]
+        except IOError:
+            pass
+        return None
+
+    def commit(self, names, contexts):
+        """Commit the current state of files ``names``, like ``commit``."""
+        now = time.time()
+        self.mark += 1
+        identity = author(contexts[0])
+        if identity:
+            name, email = identity
+            author_ident = "%s <%s>" % (_ident_part(name), _ident_part(email))
+        else:
+            author_ident = self.committer
+        message = _cleanup(commit_message(contexts).encode("utf-8"))
+        stream = ["commit %s\n" % self.branch,
+                  "mark :%d\n" % self.mark,
+                  "author %s %s\n" % (author_ident, _timestamp(now)),
+                  "committer %s %s\n" % (self.committer, _timestamp(now)),
+                  "data %d\n%s\n" % (len(message), message)]
+        if self.started:
+            stream.append("from %s^0\n" % self.branch)
+        for name in names:
+            target = self.prefix + name
+            try:
+                data = open(os.path.join(self.path, name), "rb").read()
+            except IOError:
+                stream.append("D %s\n" % target)
+            else:
+                stream.append("M 100644 inline %s\ndata %d\n%s\n" %
+                              (target, len(data), data))
+        stream.append("\ncheckpoint\n\nget-mark :%d\n" % self.mark)
+        try:
+            self.process.stdin.write("".join(stream))
+            self.process.stdin.flush()
+            sha = self.process.stdout.readline().strip()
+        except (IOError, OSError), ex:
+            raise FastImportError("git fast-import failed: %s" % ex)
+        if not sha:
+            raise FastImportError("git fast-import exited")
+        if self._ref() != sha:
+            raise FastImportError("%s changed during the commit" % self.branch)
+        self.started = True
+        self.commits += 1
+
+    def close(self):
+        """Stop the process, and bring the index up to date."""
+        try:
+            if self.started:
+                # The branch is updated again at the end, from where it
+                # is now rather than from the last commit of this process
+                self.process.stdin.write("reset %s\nfrom %s^0\n\n" %
+                                         (self.branch, self.branch))
+            self.process.stdin.write("done\n")
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+        if self.started:
+            subprocess.call(["git", "reset", "-q"], cwd=self.path)
+        if self.commits:
+            # Each checkpoint wrote a pack, let git gather them when needed
+            subprocess.call(["git", "gc", "--auto", "--quiet"], cwd=self.path)
+
+
+class FastImportError(Exception):
+    """Commit with ``git fast-import`` failed, nothing was committed."""
+
+
+class CommitQueue(object):
+    """Changes waiting to be committed, by repository.
+
+    The first change of a repository is committed ``window`` seconds after
+    it was queued, together with the changes queued in the meantime. The
+    changes of consecutive requests by the same user make one commit,
+    so that each commit keeps its author. With a window of 0, changes are
+    committed before ``change`` returns.
+
+    With ``fast_import``, commits are made by a ``FastImport`` for each
+    repository, at most ``max_importers`` of them running at a time.
+
+    """
+    attempts = 3
+    max_importers = 16
+
+    def __init__(self, window, fast_import=False):
+        self.window = window
+        self.fast_import = fast_import
+        self.importers = collections.OrderedDict()
+        self.condition = threading.Condition()
+        # Serializes the git commands, taken with ``condition`` held so
+        # that batches are committed in the order they were taken
+        self.commit_lock = threading.Lock()
+        # Pending changes and commit time, by repository
+        self.pending = {}
+        self.thread = None
+        self.commits = 0
+        self.changes = 0
+
+    def change(self, path, name, context):
+        """Queue the change of file ``name`` of repository ``path``."""
+        context = dict(context)
+        if self.window <= 0:
+            with self.commit_lock:
+                self._commit(path, [(name, context)])
+            return
+        with self.condition:
+            if path not in self.pending:
+                self.pending[path] = (time.time() + self.window, [])
+            self.pending[path][1].append((name, context))
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self._run, name="calypso-git")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _take(self, paths):
+        """Take the changes of ``paths`` and the commit lock."""
+        batches = [(path, self.pending.pop(path)[1]) for path in paths]
+        self.commit_lock.acquire()
+        return batches
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    due = [path for path, (when, _) in self.pending.items()
+                           if when <= now]
+                    if due:
+                        break
+                    timeout = None
+                    if self.pending:
+                        timeout = min(when for when, _ in
+                                      self.pending.values()) - now
+                    self.condition.wait(timeout)
+                batches = self._take(due)
+            try:
+                self._commit_all(batches)
+            finally:
+                self.commit_lock.release()
+
+    def _commit_all(self, batches):
+        for path, changes in batches:
+            try:
+                self._commit(path, changes)
+            except Exception:
+                log.exception("Failed to commit %d changes in %s",
+                              len(changes), path)
+
+    def _commit(self, path, changes):
+        """Commit ``changes``, one commit per run of the same author."""
+        start = 0
+        while start < len(changes):
+            identity = author(changes[start][1])
+            end = start + 1
+            while end < len(changes) and author(changes[end][1]) == identity:
+                end += 1
+            run = changes[start:end]
+            names = sorted(set(name for name, _ in run))
+            contexts = [context for _, context in run]
+            if not self._fast_commit(path, names, contexts):
+                for attempt in range(self.attempts, 0, -1):
+                    try:
+                        commit(path, names, contexts)
+                        break
+                    except subprocess.CalledProcessError:
+                        # Another process may hold the index lock
+                        if attempt == 1:
+                            raise
+                        time.sleep(0.1)
+            self.commits += 1
+            self.changes += len(run)
+            start = end
+
+    def _fast_commit(self, path, names, contexts):
+        """Commit with the ``FastImport`` of ``path``, return if it worked."""
+        if not self.fast_import:
+            return False
+        try:
+            importer = self.importers.pop(path, None)
+            if importer is None:
+                importer = FastImport(path)
+            # Keep the most recently used processes
+            self.importers[path] = importer
+            while len(self.importers) > self.max_importers:
+                self.importers.popitem(last=False)[1].close()
+            importer.commit(names, contexts)
+            return True
+        except (FastImportError, OSError, subprocess.CalledProcessError), ex:
+            log.warning("Cannot commit with git fast-import in %s, "
+                        "using git commit: %s", path, ex)
+            importer = self.importers.pop(path, None)
+            if importer:
+                importer.close()
+            return False
+
+    def flush(self):
+        """Commit the pending changes now, and wait for them.
+
+        The ``git fast-import`` processes are stopped as well.
+
+        """
+        with self.condition:
+            batches = self._take(list(self.pending))
+        try:
+            self._commit_all(batches)
+            while self.importers:
+                self.importers.popitem()[1].close()
+        finally:
+            self.commit_lock.release()
+
+    def stats(self):
+        """Return the number of commits made and of changes committed."""
+        return {"commits": self.commits,
+                "changes": self.changes,
+                "pending": sum(len(changes) for _, changes in
+                               self.pending.values())}
+
+
+@per_process
+def commit_queue():
+    """Return the ``CommitQueue`` of this process."""
+    return CommitQueue(
+        config.getfloat("storage", "git_commit_window"),
+        config.getboolean("storage", "git_fast_import"))
+
+
+def flush():
+    """Commit the pending changes of this process."""
+    queue = commit_queue.current()
+    if queue:
+        queue.flush()
+
+atexit.register(flush)
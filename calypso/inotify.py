@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Inotify change notifications.
+
+Watch collection directories with the Linux inotify interface, called
+through ctypes, so that collections learn which files changed instead of
+checking the directory on every access.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+import weakref
+
+from .utils import per_process
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher(object):
+    """Inotify instance, with a thread reporting the changes.
+
+    Each watched directory has owners, only weakly referenced: their
+    ``changed`` method is called with the name of each changed file, or
+    with ``None`` when anything may have changed, and their ``unwatched``
+    method when the directory is no longer watched.
+
+    """
+
+    def __init__(self):
+        """Create the inotify instance, raise ``OSError`` if unavailable."""
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.thread = threading.Thread(target=self._run, name="calypso-inotify")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, path, owner):
+        """Report the changes in directory ``path`` to ``owner``."""
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        with self.lock:
+            wd = self._add_watch(self.fd, path, WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error), path)
+            self.watches.setdefault(wd, []).append(weakref.ref(owner))
+
+    def _owners(self, wd):
+        """Return the live owners of ``wd``, dropping the watch if none."""
+        with self.lock:
+            refs = self.watches.get(wd, [])
+            owners = [ref() for ref in refs]
+            refs[:] = [ref for ref, owner in zip(refs, owners) if owner]
+            if wd in self.watches and not refs:
+                del self.watches[wd]
+                self._rm_watch(self.fd, wd)
+            return [owner for owner in owners if owner]
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                log.exception("Reading inotify events failed")
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    log.debug("Inotify queue overflow")
+                    with self.lock:
+                        wds = list(self.watches)
+                    for wd in wds:
+                        for owner in self._owners(wd):
+                            owner.changed(None)
+                    continue
+                owners = self._owners(wd)
+                if mask & (IN_IGNORED | IN_MOVE_SELF):
+                    # Removed, or moved and watched under another path
+                    with self.lock:
+                        if self.watches.pop(wd, None) and mask & IN_MOVE_SELF:
+                            self._rm_watch(self.fd, wd)
+                    for owner in owners:
+                        owner.unwatched()
+                    continue
+                for owner in owners:
+                    owner.changed(name or None)
+
+
+@per_process
+def watcher():
+    """Return the ``Watcher`` of this process, or ``None`` if unavailable."""
+    try:
+        return Watcher()
+    except (OSError, AttributeError), ex:
+        log.warning("Inotify unavailable, polling for changes: %s", ex)
+        return None
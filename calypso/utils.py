@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the modules of the server.
+
+"""
+
+import os
+import threading
+
+
+class per_process(object):
+    """Decorate a function making an object to make it once per process.
+
+    The decorated function returns the object made by the first call in
+    the current process. A forked process does not inherit the threads of
+    its parent, so objects running threads are made again in each child.
+
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.__doc__ = factory.__doc__
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+
+    def __call__(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.value = self.factory()
+            return self.value
+
+    def current(self):
+        """Return the object of this process, ``None`` if not made yet."""
+        with self.lock:
+            return self.value if self.pid == os.getpid() else None
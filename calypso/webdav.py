@@ -27,21 +27,38 @@ Define the main classes of a collection as seen from the server.
 """
 
 import os
+import stat
+import errno
 import codecs
 import time
 import calendar
 import hashlib
-import glob
 import logging
 import tempfile
 import vobject
 import string
 import re
-import subprocess
 import urllib
 import copy
-
-from . import config, paths
+import threading
+import contextlib
+import collections
+import functools
+import json
+import weakref
+
+# Use scandir where available, it saves a stat for non regular files
+# pylint: disable=F0401
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+# pylint: enable=F0401
+
+from . import config, paths, inotify, gitrepo, changelog
 
 #
 # Recursive search for 'name' within 'vobject'
@@ -58,14 +75,399 @@ def find_vobject_value(vobject, name):
             return value
     return None
 
+#
+# UID of the item held in 'vobject': its own, or the one of its first
+# event, todo, journal, free/busy or card
+#
+
+UID_COMPONENTS = ('vevent', 'vtodo', 'vjournal', 'vfreebusy', 'vcard')
+
+def find_vobject_uid(vobject):
+
+    if vobject.contents.has_key('uid'):
+        return vobject.contents['uid'][0].value
+    for kind in UID_COMPONENTS:
+        for child in vobject.contents.get(kind, []):
+            if child.contents.has_key('uid'):
+                return child.contents['uid'][0].value
+    return None
+
+#
+# Find component type, name, UID and last modification (None if unknown)
+# of the item in 'text' without parsing it into a vobject. Returns None
+# when unsure, the caller then has to parse 'text'.
+#
+
+def scan_vobject(text):
+
+    tag = None
+    depth = 0
+    names = []
+    uid = None
+    children = []
+    modified = []
+    for line in re.sub(r"\r?\n[ \t]", "", text).splitlines():
+        if not line.strip():
+            continue
+        if depth == 0 and tag:
+            # Trailing data after the item
+            return None
+        key, sep, value = line.partition(":")
+        if not sep:
+            return None
+        key = key.upper()
+        if key == "BEGIN":
+            depth += 1
+            if depth == 1:
+                tag = value.upper()
+            elif depth == 2:
+                children.append([value.lower(), None])
+            continue
+        if key == "END":
+            depth -= 1
+            if depth < 0:
+                return None
+            continue
+        if depth == 0:
+            return None
+        if key.split(";")[0] == "LAST-MODIFIED":
+            modified.append(key == "LAST-MODIFIED" and value)
+            continue
+        if key.split(";")[0] not in ("UID", "X-CALYPSO-NAME"):
+            continue
+        # Leave escapes, encodings and groups to vobject
+        if ";" in key or "." in key or "\\" in value or value != value.strip():
+            return None
+        if depth == 1 and key == "X-CALYPSO-NAME":
+            names.append(value)
+        elif depth == 1 and key == "UID":
+            uid = uid or value
+        elif depth == 2 and key == "UID" and children[-1][1] is None:
+            children[-1][1] = value
+    if depth != 0 or not tag:
+        return None
+
+    kinds = [kind for kind, _ in children]
+    if 'vevent' in kinds and 'vcard' in kinds:
+        return None
+    if names:
+        name = names[0]
+    else:
+        # Item.parse names the item, giving it a UID if needed
+        sha1 = hashlib.sha1(text).hexdigest()
+        name = sha1
+        if tag in ('VCARD', 'VEVENT'):
+            uid = uid or sha1
+            name = uid
+        else:
+            for child in children:
+                if child[0] in ('vevent', 'vcard'):
+                    child[1] = child[1] or sha1
+                    name = child[1]
+                    break
+    if not name:
+        return None
+    if not uid:
+        for kind in UID_COMPONENTS:
+            uids = [child_uid for child_kind, child_uid in children
+                    if child_kind == kind and child_uid]
+            if uids:
+                uid = uids[0]
+                break
+    last_modified = None
+    if not modified and tag != 'VCARD':
+        last_modified = ()
+    elif len(modified) == 1 and tag != 'VCARD':
+        try:
+            last_modified = tuple(time.gmtime(calendar.timegm(
+                time.strptime(modified[0], "%Y%m%dT%H%M%SZ"))))
+        except (TypeError, ValueError):
+            pass
+    return tag, name, uid, last_modified
+
+class RWLock(object):
+    """Lock shared by readers and exclusive for writers.
+
+    The thread holding the write lock may take it again or take the read
+    lock. A reader cannot upgrade to the write lock. Waiting writers keep
+    new readers out, so that they are not starved.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+
+    def _depth(self):
+        return getattr(self._local, "depth", 0)
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is not me and not self._depth():
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+            self._readers += 1
+            self._local.depth = self._depth() + 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            self._local.depth = self._depth() - 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writes += 1
+                return
+            if self._depth():
+                raise RuntimeError("Cannot upgrade a read lock")
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        """Hold the lock shared for the ``with`` block."""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Hold the lock exclusively for the ``with`` block."""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    @property
+    def reading(self):
+        """Whether this thread holds the read lock but not the write lock."""
+        return bool(self._depth()) and self._writer is not threading.current_thread()
+
+    @property
+    def busy(self):
+        """Whether any thread holds or waits for the lock."""
+        return bool(self._readers or self._writer or self._waiting)
+
+def writing(function):
+    """Decorate a ``Collection`` method to run it holding the write lock."""
+    @functools.wraps(function)
+    def locked(self, *args, **kwargs):
+        with self.lock.write():
+            return function(self, *args, **kwargs)
+    return locked
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class ParsedCache(object):
+    """Parsed vObjects of the items, least recently used first.
+
+    Trees are shared by all collections, by ETag, and evicted to stay
+    within the ``parsed_cache_mb`` budget of the storage configuration.
+
+    """
+
+    # Estimated memory of a tree: a fixed part plus twice the text
+    TREE_OVERHEAD = 16384
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trees = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, etag):
+        """Return the tree of the item with ``etag``, or ``None``."""
+        with self.lock:
+            entry = self.trees.pop(etag, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.trees[etag] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, etag, tree, length):
+        """Keep ``tree``, parsed from a text of ``length`` bytes."""
+        budget = config.getint("storage", "parsed_cache_mb") * 1024 * 1024
+        cost = self.TREE_OVERHEAD + 2 * length
+        with self.lock:
+            old = self.trees.pop(etag, None)
+            if old:
+                self.size -= old[1]
+            if cost > budget:
+                return
+            self.trees[etag] = (tree, cost)
+            self.size += cost
+            while self.size > budget:
+                _, (_, evicted) = self.trees.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        """Return the occupancy and the counters of the cache."""
+        with self.lock:
+            return {"trees": len(self.trees), "bytes": self.size,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+parsed_cache = ParsedCache()
+
 class Item(object):
 
     """Internal item. Wraps a vObject"""
 
+    # Items of every collection stay in memory, keep them small: the
+    # vObject itself is in parsed_cache
+    __slots__ = ("path", "name", "uid", "tag", "etag", "raw", "serialized",
+                 "_object", "_data", "_length", "_last_modified")
+
+    log = logging.getLogger(__name__)
+
     def __init__(self, text, name=None, path=None):
         """Initialize object from ``text`` and different ``kwargs``."""
 
-        self.log = logging.getLogger(__name__)
+        text = self.clean(text)
+        object = self.parse(text, name, path)
+        self.path = path
+        self.name = object.x_calypso_name.value
+        self.uid = find_vobject_uid(object)
+        self.tag = object.name
+        self.etag = hashlib.sha1(text).hexdigest()
+        self.raw = text
+        self.serialized = False
+        self._data = None
+        self._length = None
+        self._last_modified = None
+        if name:
+            # Named by the caller, parsing the text again would not
+            # give the same object
+            self._object = object
+        else:
+            self._object = None
+            parsed_cache.put(self.etag, object, len(text))
+
+    @classmethod
+    def from_file(cls, path):
+        """Initialize item from the file at ``path``.
+
+        Name, UID and type are scanned from the text, which is only
+        parsed if ``object`` is needed.
+
+        """
+        return cls.from_data(path, open(path, 'rb').read())
+
+    @classmethod
+    def from_data(cls, path, data):
+        """Initialize item stored at ``path`` from the file content ``data``."""
+        # Like reading the file with the utf-8 codec, reject invalid text
+        decoded = data.decode('utf-8')
+        text = cls.clean(decoded)
+        found = scan_vobject(text)
+        if found:
+            item = cls.__new__(cls)
+            item._object = None
+            item.path = path
+            item.tag, item.name, item.uid, item._last_modified = found
+            item.etag = hashlib.sha1(text).hexdigest()
+            item.raw = text
+            item._length = None
+        else:
+            item = cls(decoded, None, path)
+        item._data = None
+        item.serialized = cls.is_serialized(data, text)
+        if item.serialized:
+            # Keep the file as it is served, the text is found again
+            # from it if the object has to be parsed
+            item._data = data
+            item.raw = None
+        return item
+
+    @staticmethod
+    def is_serialized(data, text):
+        """Whether file ``data``, cleaned into ``text``, is serialized.
+
+        Files written by ``Collection.write_file`` have CRLF line endings
+        and already hold the name of the item.
+
+        """
+        return data.count("\n") == data.count("\r\n") and \
+            data.replace("\r\n", "\n") == text and \
+            re.search(r"^X-CALYPSO-NAME[;:]", text, re.M | re.I) is not None
+
+    @classmethod
+    def from_record(cls, path, record):
+        """Initialize item stored at ``path`` from its index ``record``.
+
+        The file is only read and parsed if ``object`` is needed.
+
+        """
+        item = cls.__new__(cls)
+        item._object = None
+        item.path = path
+        # JSON gives unicode, parsing gives UTF-8 encoded strings
+        item.name = _utf8(record["name"])
+        item.uid = _utf8(record["uid"])
+        item.tag = str(record["tag"])
+        item.etag = str(record["etag"])
+        item.raw = None
+        item.serialized = record["serialized"]
+        item._data = None
+        item._length = record["length"] and str(record["length"])
+        last_modified = record["last_modified"]
+        if last_modified is not None:
+            last_modified = tuple(last_modified)
+        item._last_modified = last_modified
+        return item
+
+    def record(self):
+        """Return the index record of the item.
+
+        Values not known yet are recorded as ``None`` rather than
+        parsing the item to find them.
+
+        """
+        last_modified = self._last_modified
+        if last_modified is not None:
+            last_modified = list(last_modified)
+        return {"name": self.name,
+                "uid": self.uid,
+                "tag": self.tag,
+                "etag": self.etag,
+                "serialized": self.serialized,
+                "length": self._length,
+                "last_modified": last_modified}
+
+    @staticmethod
+    def clean(text):
+        """Return ``text`` encoded in UTF-8, without control characters."""
         try:
             text = text.encode('utf8')
         except UnicodeDecodeError:
@@ -73,23 +475,25 @@ class Item(object):
 
         # Strip out control characters
 
-        text = re.sub(r"[\x01-\x09\x0b-\x1F\x7F]","",text)
+        return re.sub(r"[\x01-\x09\x0b-\x1F\x7F]","",text)
 
+    def parse(self, text, name, path):
+        """Parse cleaned ``text``, making sure the object has a name."""
         try:
-            self.object = vobject.readOne(text)
+            object = vobject.readOne(text)
         except Exception:
             self.log.exception("Parse error in %s %s", name, path)
             raise
 
 
-        if not self.object.contents.has_key('x-calypso-name'):
+        if not object.contents.has_key('x-calypso-name'):
             if not name:
-                if self.object.name == 'VCARD' or self.object.name == 'VEVENT':
-                    if not self.object.contents.has_key('uid'):
-                        self.object.add('UID').value = hashlib.sha1(text).hexdigest()
-                    name = self.object.uid.value
+                if object.name == 'VCARD' or object.name == 'VEVENT':
+                    if not object.contents.has_key('uid'):
+                        object.add('UID').value = hashlib.sha1(text).hexdigest()
+                    name = object.uid.value
                 else:
-                    for child in self.object.getChildren():
+                    for child in object.getChildren():
                         if child.name == 'VEVENT' or child.name == 'VCARD':
                             if not child.contents.has_key('uid'):
                                 child.add('UID').value = hashlib.sha1(text).hexdigest()
@@ -98,16 +502,30 @@ class Item(object):
                     if not name:
                         name = hashlib.sha1(text).hexdigest()
                 
-            self.object.add("X-CALYPSO-NAME").value = name
+            object.add("X-CALYPSO-NAME").value = name
         else:
-            names = self.object.contents[u'x-calypso-name']
+            names = object.contents[u'x-calypso-name']
             if len(names) > 1:
-                self.object.contents[u'x-calypso-name'] = [names[0]]
+                object.contents[u'x-calypso-name'] = [names[0]]
+        return object
 
-        self.path = path
-        self.name = self.object.x_calypso_name.value
-        self.tag = self.object.name
-        self.etag = hashlib.sha1(text).hexdigest()
+    @property
+    def object(self):
+        """The vObject, parsed from the text or file when not cached."""
+        if self._object is not None:
+            return self._object
+        object = parsed_cache.get(self.etag)
+        if object is None:
+            if self._data is not None:
+                text = self.clean(self._data.decode('utf-8'))
+            elif self.raw is None:
+                text = self.clean(codecs.open(self.path, encoding='utf-8').read())
+                self.raw = text
+            else:
+                text = self.raw
+            object = self.parse(text, None, self.path)
+            parsed_cache.put(self.etag, object, len(text))
+        return object
 
     @property
     def is_vcard(self):
@@ -157,6 +575,20 @@ class Item(object):
             return '.ics'
         return '.dav'
 
+    @property
+    def data(self):
+        """Serialized form of the item, encoded in UTF-8.
+
+        Serialized once, or taken from the file written for the item.
+
+        """
+        if self._data is None:
+            # Serialization transforms the tree in place, and trees are
+            # shared by the items with the same ETag, serialize a copy
+            object = self.object
+            self._data = object.duplicate(object).serialize()
+        return self._data
+
     @property
     def text(self):
         """Item text.
@@ -164,17 +596,23 @@ class Item(object):
         Text is the serialized form of the item.
 
         """
-        return self.object.serialize().decode('utf-8')
+        return self.data.decode('utf-8')
 
     @property
     def length(self):
-        return "%d" % len(self.text)
+        """Length in bytes of ``data``."""
+        if self._length is None:
+            self._length = "%d" % len(self.data)
+        return self._length
 
     @property
     def last_modified(self):
-        value = find_vobject_value(self.object, "LAST-MODIFIED")
-        if value:
-            return value.utctimetuple()
+        # The empty tuple records that the item has no LAST-MODIFIED
+        if self._last_modified is None:
+            value = find_vobject_value(self.object, "LAST-MODIFIED")
+            self._last_modified = tuple(value.utctimetuple()) if value else ()
+        if self._last_modified:
+            return time.struct_time(self._last_modified)
         return time.gmtime()
 
     def __unicode__(self):
@@ -204,23 +642,71 @@ class Item(object):
 
 
 class Pathtime(object):
-    """Path name and timestamps"""
+    """Path name and the stat fields telling whether the file changed"""
 
-    def __init__(self, path):
-    	self.path = path
-        self.mtime = self.curmtime
+    __slots__ = ("path", "stamp")
 
-    @property
-    def curmtime(self):
-        return os.path.getmtime(self.path)
+    def __init__(self, path, st=None):
+        self.path = path
+        self.stamp = self.stamp_of(st or os.stat(path))
 
-    def is_up_to_date(self):
-        newmtime = self.curmtime
-        if newmtime == self.mtime:
+    @staticmethod
+    def stamp_of(st):
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def is_up_to_date(self, st=None):
+        newstamp = self.stamp_of(st or os.stat(self.path))
+        if newstamp == self.stamp:
             return True
-        self.mtime = newmtime
+        self.stamp = newstamp
         return False
 
+def list_files(directory):
+    """Yield path and stat result of the regular files in ``directory``.
+
+    Hidden files are skipped, like the temporary files being written.
+
+    """
+    if scandir:
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_file():
+                    yield entry.path, entry.stat()
+            except OSError:
+                pass
+        return
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith("."):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            yield path, st
+
+# Hidden file of each collection directory storing the item metadata
+INDEX_NAME = ".calypso-index"
+# Hidden directory of each collection where files are written before
+# being moved in place
+TEMP_NAME = ".calypso-tmp"
+INDEX_VERSION = 3
+# Seconds between two saves of an index
+INDEX_DELAY = 60
+# The ctag is the sum of the ETags, as 160 bit numbers
+CTAG_MODULUS = 1 << 160
+
 class CalypsoError(Exception):
     def __init__(self, name, reason):
         self.name = name
@@ -233,31 +719,216 @@ class Collection(object):
     """Internal collection class."""
 
     def read_file(self, path):
-        text = codecs.open(path,encoding='utf-8').read()
-        item = Item(text, None, path)
-        return item
+        return Item.from_file(path)
+
+    def index_item(self, item):
+        self.items_by_path[item.path] = item
+        for index, key in self._index_keys(item):
+            index.setdefault(key, []).append(item)
+        self._item_list = None
+        self.etag_sum = (self.etag_sum + int(item.etag, 16)) % CTAG_MODULUS
+        self.unlogged.add(item.name)
+
+    def unindex_item(self, item):
+        del self.items_by_path[item.path]
+        for index, key in self._index_keys(item):
+            items = index[key]
+            items.remove(item)
+            if not items:
+                del index[key]
+        self._item_list = None
+        self.etag_sum = (self.etag_sum - int(item.etag, 16)) % CTAG_MODULUS
+        self.unlogged.add(item.name)
+
+    def _index_keys(self, item):
+        keys = [(self.items_by_name, item.name), (self.items_by_etag, item.etag)]
+        if item.uid:
+            keys.append((self.items_by_uid, item.uid))
+        return keys
 
     def insert_file(self, path):
+        self.index_dirty = True
+        record = self.index_records.get(os.path.basename(path))
+        if record and tuple(record["stamp"]) == self.files[path].stamp:
+            self.counters["indexed"] += 1
+            self.index_item(Item.from_record(path, record))
+            return
+        self.counters["parsed"] += 1
         try:
             item = self.read_file(path)
-            self.my_items.append(item)
+            self.index_item(item)
         except Exception, ex:
             self.log.exception("Insert %s failed", path)
             return
 
     def remove_file(self, path):
-        old_items=[]
-        for old_item in self.my_items:
-            if old_item.path == path:
-                old_items.append(old_item)
-        for old_item in old_items:
-            self.my_items.remove(old_item)
-        
+        item = self.items_by_path.get(path)
+        if item:
+            self.index_dirty = True
+            self.unindex_item(item)
+
+    def load_index(self):
+        """Return the records saved by ``save_index``, by file name."""
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            if index["version"] == INDEX_VERSION:
+                return index["items"]
+        except (IOError, ValueError, KeyError, TypeError), ex:
+            self.log.debug("No usable index for %s: %s", self.path, ex)
+        return {}
+
+    def save_index(self):
+        """Save the metadata of the items, to load them without parsing.
+
+        The records are checked against the stat of the files when
+        loaded, so an index that is out of date is still safe to use.
+
+        """
+        records = {}
+        for path, item in self.items_by_path.items():
+            record = item.record()
+            record["stamp"] = list(self.files[path].stamp)
+            records[os.path.basename(path)] = record
+        # The index and its temporary files are not part of the history
+        gitrepo.exclude(self.path, INDEX_NAME + "*")
+        try:
+            fd, temp = tempfile.mkstemp(".tmp", INDEX_NAME, dir=self.temp_dir())
+            with os.fdopen(fd, "w") as index_file:
+                json.dump({"version": INDEX_VERSION, "items": records},
+                          index_file)
+            with self.own_change():
+                os.rename(temp, self.index_path)
+        except (IOError, OSError), ex:
+            self.log.debug("Failed to save index of %s: %s", self.path, ex)
+            return
+        self.index_dirty = False
+        self.index_saved = time.time()
+
+    def update_index(self):
+        """Save the index if it changed, at most every ``INDEX_DELAY``."""
+        if self.index_path and self.index_dirty and \
+           time.time() - self.index_saved >= INDEX_DELAY:
+            self.save_index()
+
     def scan_file(self, path):
         self.remove_file(path)
         self.insert_file(path)
 
+    def wrote_file(self, path, data):
+        """Bring the collection up to date after writing ``data`` to ``path``.
+
+        The item is made from ``data`` like it would be read from the
+        file, without reading the file nor scanning the directory.
+
+        """
+        self.files[path] = Pathtime(path)
+        self.remove_file(path)
+        self.index_item(Item.from_data(path, data))
+        self.index_dirty = True
+        self.counters["written"] += 1
+        self.update_ctag()
+        self.update_index()
+        self.log_changes()
+
+    def removed_file(self, path):
+        """Bring the collection up to date after removing file ``path``."""
+        self.files.pop(path, None)
+        self.remove_file(path)
+        self.counters["written"] += 1
+        self.update_ctag()
+        self.update_index()
+        self.log_changes()
+
+    def log_changes(self, complete=False):
+        """Log the items changed since the last call in the change log.
+
+        If ``complete``, the items of the log gone from the collection
+        are logged as removed too. The sync position moves past the
+        logged changes if nothing was logged by others meanwhile.
+
+        """
+        names = self.unlogged
+        self.unlogged = set()
+        if self.change_log is None or not (names or complete):
+            return
+        if complete:
+            names.update(self.items_by_name)
+        changes = []
+        for name in names:
+            items = self.items_by_name.get(name)
+            changes.append((name, items[-1].etag if items else None))
+        try:
+            before, after = self.change_log.record(changes, complete)
+        except (IOError, OSError), ex:
+            self.log.warning("Failed to log changes of %s: %s", self.path, ex)
+            # Compare the whole collection with the log on the next scan
+            self.sync_position = None
+            return
+        if before == self.sync_position:
+            self.sync_position = after
+
+    def sync_log(self):
+        """Scan the directory again if the change log moved elsewhere.
+
+        Another process logged changes, or the log was never compared
+        with the collection: the sync position is only given to clients
+        once the items are at least as recent as the log up to it.
+
+        """
+        if self.change_log is None or \
+           self.change_log.is_at(self.sync_position):
+            return False
+        with self.lock.write():
+            if self.change_log.is_at(self.sync_position):
+                return True
+            complete = self.sync_position is None
+            try:
+                self.sync_position = self.change_log.position()
+            except (IOError, OSError), ex:
+                self.log.debug("No change log for %s: %s", self.path, ex)
+                self.sync_position = None
+            self._scan_dir(self._dir_mtime(), complete)
+        return True
+
+    def _dir_mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return 0
+
+    @contextlib.contextmanager
+    def own_change(self):
+        """Change the directory without making ``scan_dir`` read it again.
+
+        If the directory did not change since it was scanned, the new
+        modification time is recorded as scanned after the change; a
+        change from elsewhere is still found by the next scan, unless it
+        happens during the ``with`` block, which should hold a single
+        rename, link or unlink.
+
+        """
+        mtime = self._dir_mtime()
+        yield
+        if mtime == self.mtime:
+            self.mtime = self._dir_mtime()
+
     def scan_dir(self, force):
+        # Readers see the collection as it was when they took the lock
+        if self.lock.reading:
+            return
+
+        if self.sync_log():
+            return
+
+        changes = self.changes
+        if changes is not None and not force:
+            # Inotify tells which files changed, if any
+            if changes:
+                with self.lock.write():
+                    self._scan_changes()
+            return
+
         try:
             mtime = os.path.getmtime(self.path)
         except OSError:
@@ -266,108 +937,257 @@ class Collection(object):
 
         if not force and mtime == self.mtime:
             return
+        with self.lock.write():
+            self._scan_dir(mtime)
+
+    def _scan_dir(self, mtime, complete=False):
+        """Compare the directory with ``files`` and read what changed.
+
+        Listing costs one stat per file, reading and parsing is only
+        done for the new and changed files.
+
+        """
         self.log.debug("Scan %s", self.path)
+        with self.changes_lock:
+            if self.changes is not None:
+                self.changes.clear()
         self.mtime = mtime
-        filenames = glob.glob(self.pattern)
-        newfiles = []
-        for filename in filenames:
-            for file in self.files:
-                if filename == file.path:
-                    newfiles.append(file)
-                    if not file.is_up_to_date():
-                        self.log.debug("Changed %s", filename)
-                        self.scan_file(filename)
-                    break
+        self.counters["scans"] += 1
+        seen = set()
+        for path, st in list_files(self.path):
+            self.counters["stats"] += 1
+            seen.add(path)
+            self.scan_path(path, st)
+        for path in [path for path in self.files if path not in seen]:
+            self.scan_path(path, None)
+        # Records are only useful for the first scan
+        self.index_records = {}
+        self.update_ctag()
+        self.update_index()
+        self.log_changes(complete)
+        self.log.debug("Scanned %s: %s", self.path, self.counters)
+
+    def _scan_changes(self):
+        """Read again the files inotify reported as changed."""
+        with self.changes_lock:
+            if self.changes is None:
+                # No longer watched meanwhile
+                names = set([None])
             else:
-                self.log.debug("New %s", filename)
-                newfiles.append(Pathtime(filename))
-                self.insert_file(filename)
-        for file in self.files:
-            if not file.path in filenames:
-                self.log.debug("Removed %s", file.path)
-                self.remove_file(file.path)
-        h = hashlib.sha1()
-        for item in self.my_items:
-            h.update(item.etag)
-        self._ctag = '%d-' % self.mtime + h.hexdigest()
-        self.files = newfiles
-                
+                names = set(self.changes)
+                self.changes.clear()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = 0
+        if None in names:
+            self._scan_dir(mtime)
+            return
+        self.log.debug("Changes in %s: %s", self.path, names)
+        self.mtime = mtime
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            self.counters["stats"] += 1
+            if st and not stat.S_ISREG(st.st_mode):
+                st = None
+            self.scan_path(path, st)
+        self.update_ctag()
+        self.update_index()
+        self.log_changes()
+
+    def scan_path(self, path, st):
+        """Bring the item of ``path`` up to date, ``st`` is None if gone."""
+        file = self.files.get(path)
+        if st is None:
+            if file:
+                self.log.debug("Removed %s", path)
+                self.counters["removed"] += 1
+                del self.files[path]
+                self.remove_file(path)
+        elif file is None:
+            self.log.debug("New %s", path)
+            self.files[path] = Pathtime(path, st)
+            self.insert_file(path)
+        elif not file.is_up_to_date(st):
+            self.log.debug("Changed %s", path)
+            self.scan_file(path)
+
+    def changed(self, name):
+        """Called by inotify when file ``name``, or anything if None, changed."""
+        if name and name.startswith("."):
+            return
+        with self.changes_lock:
+            if self.changes is not None:
+                self.changes.add(name)
+
+    def unwatched(self):
+        """Called by inotify when the directory is no longer watched.
+
+        Changes are found by polling the directory again, and the next
+        access reads it whole.
+
+        """
+        self.log.debug("No longer watching %s", self.path)
+        with self.changes_lock:
+            self.changes = None
+            self.mtime = None
+
+    def update_ctag(self):
+        self._ctag = '%040x' % self.etag_sum
+
     def __init__(self, path):
         """Initialize the collection with ``cal`` and ``user`` parameters."""
         
         self.log = logging.getLogger(__name__)
+        # Shared by requests reading the collection, exclusive for changes
+        self.lock = RWLock()
         self.encoding = "utf-8"
         self.owner = paths.url_to_owner(path)
         self.path = paths.url_to_file(path)
-        self.pattern = os.path.join(self.path, "*")
-        self.files = []
-        self.my_items = []
+        # Files and items of the collection, by path
+        self.files = {}
+        self.items_by_path = {}
+        # Lists of items, by name, UID and ETag
+        self.items_by_name = {}
+        self.items_by_uid = {}
+        self.items_by_etag = {}
+        self._item_list = None
+        # Sum of the ETags of the items, the ctag, kept up to date as
+        # items come and go instead of hashing all the ETags again
+        self.etag_sum = 0
+        # Names of the items changed since they were last logged
+        self.unlogged = set()
+        # Cost of keeping up with the directory, for the curious
+        self.counters = {"scans": 0, "stats": 0, "parsed": 0, "indexed": 0,
+                         "removed": 0, "written": 0}
+        # Metadata of the items saved in the directory, loaded at startup
+        self.index_path = None
+        self.index_records = {}
+        self.index_dirty = False
+        self.index_saved = 0
+        if config.getboolean("storage", "index"):
+            self.index_path = os.path.join(self.path, INDEX_NAME)
+            self.index_records = self.load_index()
         self.mtime = 0
         self._ctag = ''
-        self.etag = hashlib.sha1(self.path).hexdigest()
-        self.scan_dir(False)
+        # Names of the files changed since the last scan, None meaning
+        # any file, when inotify watches the directory
+        self.changes = None
+        self.changes_lock = threading.Lock()
+        if config.getboolean("storage", "inotify"):
+            self.watch()
+        # Log of the changes of the items, for the sync-collection
+        # report, and the position in it matching the items in memory
+        self.change_log = None
+        self.sync_position = None
+        if config.getboolean("storage", "change_log"):
+            gitrepo.exclude(self.path, changelog.CHANGES_NAME + "*")
+            self.change_log = changelog.ChangeLog(self.path)
+        self.scan_dir(True)
         self.tag = "Collection"
 
+    def watch(self):
+        """Learn about changes from inotify, polling is kept as fallback."""
+        watcher = inotify.watcher()
+        if not watcher:
+            return
+        try:
+            watcher.watch(self.path, self)
+            self.changes = set()
+        except OSError, ex:
+            self.log.debug("Not watching %s: %s", self.path, ex)
+
     def __str__(self):
         return "Calendar-%s (at %s)" % (self.name, self.path)
 
+    @property
+    def my_items(self):
+        """List of the items, without checking the directory."""
+        if self._item_list is None:
+            self._item_list = list(self.items_by_path.values())
+        return self._item_list
+
     def __repr__(self):
         return "<Calendar %s>" % (self.name)
         
     def has_git(self):
         return True
 
-    def git_commit(self, context):
-        args = ["git", "commit", "--allow-empty"]
-        env = {}
-
-        message = context.get('action', 'other action')
-
-        if "user" in context:
-            # use environment variables instead of --author to avoid git
-            # looking it up in previous commits if it doesn't seem well-formed
-            env['GIT_AUTHOR_NAME'] = context['user'] or "unknown"
-            env['GIT_AUTHOR_EMAIL'] = "%s@webdav"%context['user']
-            # supress a chatty message that we could configure author
-            # information explicitly in the config file. (slicing it in after
-            # the git command as position is important with git arguments)
-            args[1:1] = ["-c", "advice.implicitIdentity=false"]
-        if "user-agent" in context:
-            message += u"\n\nUser-Agent: %r"%context['user-agent']
-
-        args.extend(["-m", message.encode('utf8')])
-
-        subprocess.check_call(args, cwd=self.path, env=env)
-
     def git_add(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "add", os.path.basename(path)], cwd=self.path)
-            self.git_commit(context=context)
-    
+            gitrepo.commit_queue().change(
+                self.path, os.path.basename(path), context)
+
     def git_rm(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "rm", os.path.basename(path)], cwd=self.path)
-            self.git_commit(context=context)
+            gitrepo.commit_queue().change(
+                self.path, os.path.basename(path), context)
 
     def git_change(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "add", os.path.basename(path)], cwd=self.path)
-            self.git_commit(context=context)
-            # Touch directory so that another running instance will update
-            try:
-                os.utime(self.path, None)
-            except Exception, ex:
-                self.log.exception("Failed to set directory mtime")
-            
-    def write_file(self, item):
-        fd, path = tempfile.mkstemp(item.file_extension, item.file_prefix, dir=self.path)
+            gitrepo.commit_queue().change(
+                self.path, os.path.basename(path), context)
+
+    def sync_dir(self):
+        """Make the files renamed or removed in the directory durable."""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def temp_dir(self):
+        """Return the directory of the temporary files, made if needed.
+
+        Writing and removing files there leaves the collection directory
+        alone, so only moving them in place is a change of the collection,
+        and other processes never see a partially written item.
+
+        """
+        path = os.path.join(self.path, TEMP_NAME)
+        try:
+            os.mkdir(path)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        else:
+            gitrepo.exclude(self.path, TEMP_NAME)
+        return path
+
+    def write_temp(self, item):
+        """Write ``item`` to a temporary file and return its path."""
+        fd, path = tempfile.mkstemp(item.file_extension, "." + item.file_prefix, dir=self.temp_dir())
         self.log.debug('Trying to write to %s', path)
         file = os.fdopen(fd, 'w')
-        file.write(item.text.encode('utf-8'))
+        file.write(item.data)
+        file.flush()
+        os.fsync(fd)
         file.close()
         self.log.debug('Wrote %s to %s', file, path)
         return path
 
+    def write_file(self, item):
+        """Write ``item`` to a new file, which appears once complete."""
+        while True:
+            temp = self.write_temp(item)
+            path = os.path.join(self.path, os.path.basename(temp)[1:])
+            try:
+                # Unlike rename, link never replaces an existing file
+                with self.own_change():
+                    os.link(temp, path)
+            except OSError, ex:
+                if ex.errno != errno.EEXIST:
+                    os.unlink(temp)
+                    raise
+                path = None
+            os.unlink(temp)
+            if path:
+                return path
+
     def create_file(self, item, context):
         # Create directory if necessary
         self.log.debug("Add %s", item.name)
@@ -382,8 +1202,9 @@ class Collection(object):
 
         try:
             path = self.write_file(item)
+            self.sync_dir()
+            self.wrote_file(path, item.data)
             self.git_add(path, context=context)
-            self.scan_dir(True)
         except OSError, ex:
             self.log.exception("Error writing file")
             raise
@@ -398,9 +1219,11 @@ class Collection(object):
         context['action'] = u'Remove %s'%item
 
         try:
-            os.unlink(item.path)
+            with self.own_change():
+                os.unlink(item.path)
+            self.sync_dir()
+            self.removed_file(item.path)
             self.git_rm(item.path, context=context)
-            self.scan_dir(True)
         except Exception, ex:
             self.log.exception("Failed to remove %s", item.path)
             raise
@@ -411,30 +1234,58 @@ class Collection(object):
         context['action'] = u'Modify %s'%item
 
         try:
-            new_path = self.write_file(item)
-            os.rename(new_path, item.path)
-            self.scan_file(item.path)
+            new_path = self.write_temp(item)
+            with self.own_change():
+                os.rename(new_path, item.path)
+            self.sync_dir()
+            self.wrote_file(item.path, item.data)
             self.git_change(item.path, context=context)
-            self.scan_dir(True)
         except Exception, ex:
             self.log.exception("Failed to rewrite %s", item.path)
             raise
         
+    def open_file(self, item):
+        """Open the file of ``item`` if it holds ``item.data`` as it is.
+
+        Return ``None`` if the file is not serialized, or changed since
+        the collection read it.
+
+        """
+        pathtime = self.files.get(item.path)
+        if not item.serialized or not pathtime:
+            return None
+        try:
+            file = open(item.path, 'rb')
+        except IOError:
+            return None
+        if Pathtime.stamp_of(os.fstat(file.fileno())) != pathtime.stamp:
+            file.close()
+            return None
+        return file
+
     def get_item(self, name):
         """Get collection item called ``name``."""
-        for item in self.my_items:
-            if item.name == name:
-                return item
+        items = self.items_by_name.get(name)
+        if items:
+            return items[0]
         return None
 
     def get_items(self, name):
         """Get collection items called ``name``."""
-        items=[]
-        for item in self.my_items:
-            if item.name == name:
-                items.append(item)
-        return items
+        return list(self.items_by_name.get(name, ()))
+
+    def get_items_by_uid(self, uid):
+        """Get collection items whose UID is ``uid``."""
+        return list(self.items_by_uid.get(uid, ()))
 
+    def get_item_by_etag(self, etag):
+        """Get the collection item whose ETag is ``etag``."""
+        items = self.items_by_etag.get(etag)
+        if items:
+            return items[0]
+        return None
+
+    @writing
     def append(self, name, text, context):
         """Append items from ``text`` to collection.
 
@@ -447,19 +1298,20 @@ class Collection(object):
         except Exception, e:
             self.log.exception("Cannot create new item")
             raise
-        if new_item.name in (item.name for item in self.my_items):
+        if self.get_item(new_item.name):
             self.log.debug("Item %s already present %s" , new_item.name, self.get_item(new_item.name).path)
             raise CalypsoError(new_item.name, "Item already present")
         self.log.debug("New item %s", new_item.name)
         self.create_file(new_item, context=context)
 
+    @writing
     def remove(self, name, context):
         """Remove object named ``name`` from collection."""
         self.log.debug("Remove object %s", name)
-        for old_item in self.my_items:
-            if old_item.name == name:
-                self.destroy_file(old_item, context=context)
+        for old_item in self.get_items(name):
+            self.destroy_file(old_item, context=context)
                 
+    @writing
     def replace(self, name, text, context):
         """Replace content by ``text`` in objet named ``name`` in collection."""
 
@@ -491,6 +1343,7 @@ class Collection(object):
             self.create_file(new_item, context={})
             self.log.debug("Added %s from %s", new_item.name, path)
 
+    @writing
     def import_file(self, path):
         """Merge items from ``path`` to collection.
         """
@@ -519,12 +1372,37 @@ class Collection(object):
     def write(self, headers=None, items=None):
         return True
 
+    @property
+    def sync_token(self):
+        """Sync token of the collection, None without a change log."""
+        self.scan_dir(False)
+        if self.change_log is None or self.sync_position is None:
+            return None
+        return self.change_log.token(self.sync_position)
+
+    def changes_since(self, token):
+        """Return the last ETag of the items changed after sync ``token``.
+
+        Removed items have a ``None`` ETag. Raise
+        ``changelog.InvalidSyncToken`` if the changes cannot be told.
+
+        """
+        self.scan_dir(False)
+        if self.change_log is None or self.sync_position is None:
+            raise changelog.InvalidSyncToken(token)
+        return self.change_log.since(token, self.sync_position)
+
     @property
     def ctag(self):
         self.scan_dir(False)
         """Ctag from collection."""
         return self._ctag
 
+    @property
+    def etag(self):
+        """ETag of the collection, changing with its ctag."""
+        return hashlib.sha1(self.ctag).hexdigest()
+
     @property
     def name(self):
         """Collection name."""
@@ -533,11 +1411,13 @@ class Collection(object):
     @property
     def text(self):
         """Collection as plain text."""
+        return "".join(self.iter_data()).decode('utf-8')
+
+    def iter_data(self):
+        """Yield the serialized items of the collection, encoded in UTF-8."""
         self.scan_dir(False)
-        _text = ""
         for item in self.my_items:
-            _text = _text + item.text
-        return _text
+            yield item.data
 
     @property
     def headers(self):
@@ -562,4 +1442,133 @@ class Collection(object):
 
     @property
     def length(self):
-        return "%d" % len(self.text)
+        """Length in bytes of the collection as UTF-8 encoded text."""
+        return "%d" % sum(int(item.length) for item in self.items)
+
+
+class CollectionCache(object):
+    """Collections by path, the least recently used ones first.
+
+    At most ``cached_collections`` of the storage configuration are kept,
+    and none unused for ``collection_idle`` seconds, 0 meaning no limit.
+    Busy collections are not evicted. Evicted collections still used by a
+    request are found again instead of being read twice, so that each
+    path keeps a single lock.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Path to collection and time of last use
+        self.collections = collections.OrderedDict()
+        self.evicted = weakref.WeakValueDictionary()
+        # Path to the event set once the collection has been read
+        self.loading = {}
+        # Cache replacing this one, see forget
+        self.successor = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """Return the collection at ``path``, reading it if needed.
+
+        The collection is read without holding the cache lock, so that
+        requests to cached collections do not wait for a cold one. Other
+        requests for the same path wait for the first reader instead of
+        reading it again.
+
+        """
+        while True:
+            with self.lock:
+                entry = self.collections.pop(path, None)
+                if entry:
+                    collection = entry[0]
+                else:
+                    collection = self.evicted.pop(path, None)
+                if collection is not None:
+                    self.hits += 1
+                    self.collections[path] = (collection, time.time())
+                    evicted = self._evict()
+                    break
+                loading = self.loading.get(path)
+                # Set ones are left over from a forgotten cache
+                if loading is None or loading.is_set():
+                    loading = self.loading[path] = threading.Event()
+                    self.misses += 1
+                    break
+            # Read by another request, take it from the cache once done
+            loading.wait()
+        if collection is None:
+            try:
+                collection = Collection(path)
+            finally:
+                with self.lock:
+                    del self.loading[path]
+                    if collection is not None:
+                        self.collections[path] = (collection, time.time())
+                        evicted = self._evict()
+                if collection is not None and self.successor is not None:
+                    self.successor.adopt(path, collection, loading)
+                loading.set()
+        for old in evicted:
+            with old.lock.read():
+                if old.index_path and old.index_dirty:
+                    old.save_index()
+        return collection
+
+    def adopt(self, path, collection, loading):
+        """Take ``collection``, read meanwhile by the cache forgotten."""
+        with self.lock:
+            self.evicted[path] = collection
+            if self.loading.get(path) is loading:
+                del self.loading[path]
+        if self.successor is not None:
+            self.successor.adopt(path, collection, loading)
+
+    def forget(self):
+        """Return a new cache replacing this one, emptied.
+
+        Collections still used by requests, or being read, are found by
+        the new cache instead of being read twice. Safe to call from a
+        signal handler: this cache is neither locked nor modified, but for
+        its successor, set first so that the collections read from then
+        on are adopted.
+
+        """
+        cache = CollectionCache()
+        self.successor = cache
+        cache.loading.update(self.loading)
+        for path, (collection, used) in dict.items(self.collections):
+            cache.evicted[path] = collection
+        for path, collection in self.evicted.items():
+            cache.evicted[path] = collection
+        return cache
+
+    def _evict(self):
+        size = config.getint("storage", "cached_collections")
+        idle = config.getint("storage", "collection_idle")
+        excess = len(self.collections) - size if size else 0
+        deadline = time.time() - idle
+        victims = []
+        for path, (collection, used) in self.collections.iteritems():
+            if len(victims) >= excess and not (idle and used < deadline):
+                break
+            if not collection.lock.busy:
+                victims.append(path)
+        evicted = []
+        for path in victims:
+            collection = self.collections.pop(path)[0]
+            self.evicted[path] = collection
+            self.evictions += 1
+            evicted.append(collection)
+        return evicted
+
+    def stats(self):
+        """Return the occupancy and the counters of the cache."""
+        with self.lock:
+            cached = [entry[0] for entry in self.collections.itervalues()]
+            return {"collections": len(cached),
+                    "items": sum(len(c.items_by_path) for c in cached),
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
@@ -171,6 +171,8 @@ def propfind(path, xml_request, collection, depth):
                     element.text = "text/calendar"
             elif tag == _tag("CS", "getctag") and is_collection:
                 element.text = item.ctag
+            elif tag == _tag("D", "sync-token") and is_collection:
+                element.text = item.sync_token
             elif tag == _tag("D", "getetag"):
                 element.text = item.etag
             elif tag == _tag("D", "displayname") and is_collection:
@@ -200,6 +202,11 @@ def propfind(path, xml_request, collection, depth):
                 element.append(tag)
                 tag = ET.Element(_tag("C", "filter"))
                 element.append(tag)
+                report = ET.Element(_tag("D", "report"))
+                report.append(ET.Element(_tag("D", "sync-collection")))
+                tag = ET.Element(_tag("D", "supported-report"))
+                tag.append(report)
+                element.append(tag)
             elif tag == _tag("D", "current-user-privilege-set"):
                 privilege = ET.Element(_tag("D", "privilege"))
                 privilege.append(ET.Element(_tag("D", "all")))
@@ -222,7 +229,7 @@ def propfind(path, xml_request, collection, depth):
 def put(path, webdav_request, collection, context):
     """Read PUT requests."""
     name = paths.resource_from_path(path)
-    if name in (item.name for item in collection.items):
+    if collection.get_item(name):
         # PUT is modifying an existing item
         collection.replace(name, webdav_request, context=context)
     else:
@@ -298,6 +305,76 @@ def match_filter(item, filter):
         if match_filter_element(item.object, fe):
             return True
 
+def _item_response(href, item, props):
+    """Return the response of a REPORT giving ``props`` of ``item``."""
+    response = ET.Element(_tag("D", "response"))
+
+    href_element = ET.Element(_tag("D", "href"))
+    href_element.text = href
+    response.append(href_element)
+
+    propstat = ET.Element(_tag("D", "propstat"))
+    response.append(propstat)
+
+    prop = ET.Element(_tag("D", "prop"))
+    propstat.append(prop)
+
+    for tag in props:
+        element = ET.Element(tag)
+        if tag == _tag("D", "getetag"):
+            element.text = item.etag
+        elif tag == _tag("C", "calendar-data"):
+            element.text = item.text
+        prop.append(element)
+
+    status = ET.Element(_tag("D", "status"))
+    status.text = _response(200)
+    propstat.append(status)
+
+    return response
+
+
+def sync_collection(path, root, props, collection):
+    """Answer sync-collection REPORT requests.
+
+    Read rfc6578-3.2 for info. An empty sync token asks for every item,
+    a token given before for the items changed or removed since, removed
+    items being answered with a 404 status.
+
+    """
+    multistatus = ET.Element(_tag("D", "multistatus"))
+    path = path.rstrip("/") + "/"
+
+    token = root.findtext(_tag("D", "sync-token")) or ""
+    token = token.strip()
+    if token:
+        changes = collection.changes_since(token)
+        for name in sorted(changes):
+            items = collection.get_items(name)
+            for item in items:
+                multistatus.append(_item_response(path + name, item, props))
+            if not items:
+                response = ET.Element(_tag("D", "response"))
+                href = ET.Element(_tag("D", "href"))
+                href.text = path + name
+                response.append(href)
+                status = ET.Element(_tag("D", "status"))
+                status.text = _response(404)
+                response.append(status)
+                multistatus.append(response)
+    else:
+        for item in collection.items:
+            multistatus.append(_item_response(path + item.name, item, props))
+
+    sync_token = collection.sync_token
+    if sync_token is not None:
+        element = ET.Element(_tag("D", "sync-token"))
+        element.text = sync_token
+        multistatus.append(element)
+
+    return ET.tostring(multistatus, config.get("encoding", "request"))
+
+
 def report(path, xml_request, collection):
     """Read and answer REPORT requests.
 
@@ -311,6 +388,9 @@ def report(path, xml_request, collection):
     prop_list = prop_element.getchildren()
     props = [prop.tag for prop in prop_list]
 
+    if collection and root.tag == _tag("D", "sync-collection"):
+        return sync_collection(path, root, props, collection)
+
     filter_element = root.find(_tag("C", "filter"))
 
     if collection:
@@ -332,7 +412,7 @@ def report(path, xml_request, collection):
         if name:
             # Reference is an item
             path = paths.collection_from_path(hreference) + "/"
-            items = (item for item in collection.items if item.name == name)
+            items = collection.get_items(name)
         else:
             # Reference is a collection
             path = hreference
@@ -340,33 +420,16 @@ def report(path, xml_request, collection):
 
         
         for item in items:
-            if not match_filter(item, filter_element):
+            try:
+                if not match_filter(item, filter_element):
+                    continue
+            except Exception:
+                # Items are only parsed when needed, skip unreadable ones
+                log.exception("Cannot filter %s", item.path)
                 continue
 
-            response = ET.Element(_tag("D", "response"))
-            multistatus.append(response)
-
-            href = ET.Element(_tag("D", "href"))
-            href.text = path.rstrip('/') + '/' + item.name
-            response.append(href)
-
-            propstat = ET.Element(_tag("D", "propstat"))
-            response.append(propstat)
-
-            prop = ET.Element(_tag("D", "prop"))
-            propstat.append(prop)
-
-            for tag in props:
-                element = ET.Element(tag)
-                if tag == _tag("D", "getetag"):
-                    element.text = item.etag
-                elif tag == _tag("C", "calendar-data"):
-                    element.text = item.text
-                prop.append(element)
-
-            status = ET.Element(_tag("D", "status"))
-            status.text = _response(200)
-            propstat.append(status)
+            multistatus.append(_item_response(
+                path.rstrip('/') + '/' + item.name, item, props))
 
     reply = ET.tostring(multistatus, config.get("encoding", "request"))
         
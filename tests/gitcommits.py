@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Commits per second, with git commit and with git fast-import.
+
+Make the same changes to two repositories, with a commit for each,
+once through ``git add`` and ``git commit`` and once through a
+long-running ``git fast-import``, then check that both histories have
+the same trees, authors, committers and messages.
+
+Run it from the top of the source tree:
+
+    python tests/gitcommits.py [commits]
+
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from calypso import gitrepo
+
+# Tree, author, committer and message of each commit
+LOG_FORMAT = "--format=%T|%an|%ae|%cn|%ce|%B"
+
+
+def change(directory, number):
+    """Change a file of ``directory``, return its name and the context."""
+    name = "f%d.ics" % (number % 50)
+    path = os.path.join(directory, name)
+    if number % 7 == 6 and os.path.exists(path):
+        os.unlink(path)
+        context = {"action": u"Remove %s" % name, "user": "bob",
+                   "user-agent": "Test/1.0"}
+    else:
+        open(path, "w").write(
+            "BEGIN:VCALENDAR\r\nX-NUMBER:%d\r\nEND:VCALENDAR\r\n" % number)
+        context = {"action": u"Modify \xe9 %s" % name,
+                   "user": "alice" if number % 3 else None}
+    if number % 11 == 0:
+        context = {"action": u"Import %s" % name}
+    return name, context
+
+
+def run(directory, commits, fast_import):
+    """Commit ``commits`` changes, return the time taken."""
+    os.makedirs(directory)
+    subprocess.check_call(["git", "init", "-q", directory])
+    subprocess.check_call(
+        ["git", "config", "user.name", "Calypso"], cwd=directory)
+    subprocess.check_call(
+        ["git", "config", "user.email", "calypso@localhost"], cwd=directory)
+    # No window: each change is committed on its own
+    queue = gitrepo.CommitQueue(0, fast_import)
+    started = time.time()
+    for number in range(commits):
+        name, context = change(directory, number)
+        queue.change(directory, name, context)
+    queue.flush()
+    return time.time() - started
+
+
+def history(directory):
+    log = subprocess.check_output(["git", "log", LOG_FORMAT], cwd=directory)
+    return re.sub(r"\s+", " ", log)
+
+
+def main(commits=200):
+    home = tempfile.mkdtemp(prefix="calypso-gitcommits-")
+    try:
+        plain = os.path.join(home, "commit")
+        fast = os.path.join(home, "fast-import")
+        elapsed = run(plain, commits, False)
+        print "git commit: %d commits in %.2fs, %.0f/s" % (
+            commits, elapsed, commits / elapsed)
+        elapsed = run(fast, commits, True)
+        print "git fast-import: %d commits in %.2fs, %.0f/s" % (
+            commits, elapsed, commits / elapsed)
+        if history(plain) != history(fast):
+            print "histories differ"
+            return 1
+        if subprocess.check_output(["git", "status", "--porcelain"], cwd=fast):
+            print "files left uncommitted by git fast-import"
+            return 1
+        print "OK"
+        return 0
+    finally:
+        shutil.rmtree(home, True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
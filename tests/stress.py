@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stress test of the collection locking.
+
+Hammer one collection from many threads, writers adding, replacing and
+removing items while readers check that they always see a consistent
+collection, both through HTTP requests to a server with a worker pool
+and through the ``Collection`` methods directly. At the end, the items
+in memory must be the ones found by reading the directory again.
+
+Run it from the top of the source tree:
+
+    python tests/stress.py [writers] [readers] [rounds]
+
+"""
+
+import httplib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from calypso import config
+
+EVENT = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Calypso//Stress test//EN
+BEGIN:VEVENT
+UID:%s
+DTSTART:20200101T100000Z
+DTEND:20200101T110000Z
+SUMMARY:Event %s
+END:VEVENT
+END:VCALENDAR
+"""
+
+COLLECTION = "/user/stress"
+
+PROPFIND = """<?xml version="1.0"?>
+<D:propfind xmlns:D="DAV:" xmlns:CS="http://calendarserver.org/ns/">
+<D:prop><D:getetag/><CS:getctag/></D:prop></D:propfind>"""
+
+REPORT = """<?xml version="1.0"?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+<D:prop><D:getetag/><C:calendar-data/></D:prop></C:calendar-query>"""
+
+
+class Stress(object):
+    """Writers and readers sharing one collection, and their failures."""
+
+    def __init__(self, port, collection, rounds):
+        self.port = port
+        self.collection = collection
+        self.rounds = rounds
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def run(self, function, *args):
+        """Run ``function``, keeping its failure instead of raising it."""
+        try:
+            function(*args)
+        except Exception:
+            with self.lock:
+                self.errors.append(traceback.format_exc())
+
+    def request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def http_writer(self, number):
+        connection = httplib.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        headers = {"Content-Type": "text/calendar"}
+        for round in range(self.rounds):
+            uid = "http-%d-%d" % (number, round)
+            path = "%s/%s.ics" % (COLLECTION, uid)
+            status, _ = self.request(
+                connection, "PUT", path, EVENT % (uid, round), headers)
+            assert status == 201, (path, status)
+            if round % 3 == 0:
+                status, _ = self.request(
+                    connection, "PUT", path, EVENT % (uid, "changed"), headers)
+                assert status == 201, (path, status)
+            if round % 5 == 0:
+                status, _ = self.request(connection, "DELETE", path)
+                assert status == 204, (path, status)
+
+    def http_reader(self, number):
+        connection = httplib.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        for round in range(self.rounds):
+            status, data = self.request(connection, "GET", COLLECTION + "/")
+            assert status == 200, status
+            assert data.count("BEGIN:VEVENT") == data.count("END:VEVENT") \
+                == data.count("BEGIN:VCALENDAR"), "torn items"
+            status, data = self.request(
+                connection, "PROPFIND", COLLECTION + "/", PROPFIND,
+                {"Depth": "1"})
+            assert status == 207, status
+            status, data = self.request(
+                connection, "REPORT", COLLECTION + "/", REPORT, {"Depth": "1"})
+            assert status == 207, status
+
+    def api_writer(self, number):
+        for round in range(self.rounds):
+            uid = "api-%d-%d" % (number, round)
+            name = uid + ".ics"
+            self.collection.append(
+                name, (EVENT % (uid, round)).decode("utf-8"), context={})
+            if round % 3 == 0:
+                self.collection.replace(
+                    name, (EVENT % (uid, "changed")).decode("utf-8"),
+                    context={})
+            if round % 5 == 0:
+                self.collection.remove(name, context={})
+
+    def api_reader(self, number):
+        for round in range(self.rounds):
+            self.collection.scan_dir(False)
+            with self.collection.lock.read():
+                items = self.collection.items
+                names = [item.name for item in items]
+                assert len(set(names)) == len(names), "duplicate items"
+                text = self.collection.text
+                assert text.count("BEGIN:VEVENT") == len(items), \
+                    (text.count("BEGIN:VEVENT"), len(items))
+
+
+def main(writers=4, readers=8, rounds=15):
+    home = tempfile.mkdtemp(prefix="calypso-stress-")
+    try:
+        folder = os.path.join(home, "calendars")
+        config.set("storage", "folder", folder)
+        config.set("server", "workers", str(writers + readers))
+        directory = os.path.join(folder, COLLECTION.strip("/"))
+        os.makedirs(directory)
+        try:
+            subprocess.check_call(["git", "init", "-q", directory])
+            subprocess.check_call(
+                ["git", "config", "user.name", "Calypso"], cwd=directory)
+            subprocess.check_call(
+                ["git", "config", "user.email", "calypso@localhost"],
+                cwd=directory)
+        except (OSError, subprocess.CalledProcessError):
+            print "git not found, testing without commits"
+
+        import calypso
+        from calypso import gitrepo, webdav
+
+        server = calypso.HTTPServer(
+            ("127.0.0.1", 0), calypso.CollectionHTTPHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        collection = calypso.CollectionHTTPHandler.collections.get(COLLECTION)
+        stress = Stress(server.server_address[1], collection, rounds)
+        threads = []
+        for number in range(writers):
+            for function in (stress.http_writer, stress.api_writer):
+                threads.append(threading.Thread(
+                    target=stress.run, args=(function, number)))
+        for number in range(readers):
+            for function in (stress.http_reader, stress.api_reader):
+                threads.append(threading.Thread(
+                    target=stress.run, args=(function, number)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gitrepo.flush()
+
+        for error in stress.errors:
+            print error
+        collection.scan_dir(False)
+        expected = 2 * writers * (rounds - len(range(0, rounds, 5)))
+        names = sorted(item.name for item in collection.items)
+        fresh = sorted(item.name for item in webdav.Collection(COLLECTION).items)
+        print "%d threads, %d items, %d errors" % (
+            len(threads), len(names), len(stress.errors))
+        if stress.errors:
+            return 1
+        if len(names) != expected:
+            print "expected %d items" % expected
+            return 1
+        if names != fresh:
+            print "items in memory differ from the directory"
+            return 1
+        print "OK"
+        return 0
+    finally:
+        shutil.rmtree(home, True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,111 @@
+/*
+ * This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+ *
+ * This library is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Count the system calls writing to sockets, loaded with LD_PRELOAD by
+ * tests/syscount.py. The counts are appended to the file named by the
+ * SYSCOUNT_OUT environment variable when the process exits.
+ */
+
+#define _GNU_SOURCE
+#define _LARGEFILE64_SOURCE
+#include <dlfcn.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/sendfile.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <sys/uio.h>
+#include <unistd.h>
+
+static long n_send, n_write, n_sendfile;
+
+#define NEXT(name) \
+    static __typeof__(name) *next; \
+    if (!next) \
+        next = (__typeof__(name) *)dlsym(RTLD_NEXT, #name)
+
+static int is_socket(int fd)
+{
+    struct stat st;
+    return fstat(fd, &st) == 0 && S_ISSOCK(st.st_mode);
+}
+
+ssize_t send(int fd, const void *buf, size_t len, int flags)
+{
+    NEXT(send);
+    __sync_fetch_and_add(&n_send, 1);
+    return next(fd, buf, len, flags);
+}
+
+ssize_t sendto(int fd, const void *buf, size_t len, int flags,
+               const struct sockaddr *addr, socklen_t addrlen)
+{
+    NEXT(sendto);
+    __sync_fetch_and_add(&n_send, 1);
+    return next(fd, buf, len, flags, addr, addrlen);
+}
+
+ssize_t sendmsg(int fd, const struct msghdr *msg, int flags)
+{
+    NEXT(sendmsg);
+    __sync_fetch_and_add(&n_send, 1);
+    return next(fd, msg, flags);
+}
+
+ssize_t write(int fd, const void *buf, size_t len)
+{
+    NEXT(write);
+    if (is_socket(fd))
+        __sync_fetch_and_add(&n_write, 1);
+    return next(fd, buf, len);
+}
+
+ssize_t writev(int fd, const struct iovec *iov, int count)
+{
+    NEXT(writev);
+    if (is_socket(fd))
+        __sync_fetch_and_add(&n_write, 1);
+    return next(fd, iov, count);
+}
+
+ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count)
+{
+    NEXT(sendfile);
+    __sync_fetch_and_add(&n_sendfile, 1);
+    return next(out_fd, in_fd, offset, count);
+}
+
+ssize_t sendfile64(int out_fd, int in_fd, off64_t *offset, size_t count)
+{
+    NEXT(sendfile64);
+    __sync_fetch_and_add(&n_sendfile, 1);
+    return next(out_fd, in_fd, offset, count);
+}
+
+__attribute__((destructor)) static void report(void)
+{
+    const char *path = getenv("SYSCOUNT_OUT");
+    FILE *file;
+
+    if (!path || !(file = fopen(path, "a")))
+        return;
+    fprintf(file, "%d send=%ld write=%ld sendfile=%ld\n",
+            (int)getpid(), n_send, n_write, n_sendfile);
+    fclose(file);
+}
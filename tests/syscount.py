@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Count the system calls writing the responses to the sockets.
+
+Run a server with the ``syscount.c`` shim preloaded, send it a mix of
+single item GET, PROPFIND, calendar-multiget REPORT and whole collection
+GET requests on one keep-alive connection, then print how many ``send``,
+``write`` and ``sendfile`` calls the server made. Linux only, needs git
+and a C compiler for the shim.
+
+Run it from the top of the source tree, on each version to compare:
+
+    python tests/syscount.py [rounds]
+
+"""
+
+import httplib
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(TESTS)
+
+EVENT = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Calypso//Syscall count//EN
+BEGIN:VEVENT
+UID:%s
+DTSTART:20200101T100000Z
+SUMMARY:Event %s
+END:VEVENT
+END:VCALENDAR
+"""
+
+COLLECTION = "/user/count"
+
+PROPFIND = """<?xml version="1.0"?>
+<D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop></D:propfind>"""
+
+MULTIGET = """<?xml version="1.0"?>
+<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+<D:prop><D:getetag/><C:calendar-data/></D:prop>
+<D:href>%s/e1.ics</D:href></C:calendar-multiget>""" % COLLECTION
+
+ITEMS = 20
+
+
+def free_port():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def connect(port):
+    """Return a connection to the server, once it listens."""
+    for attempt in range(50):
+        connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            connection.connect()
+            return connection
+        except socket.error:
+            connection.close()
+            time.sleep(0.1)
+    raise RuntimeError("server not listening on port %d" % port)
+
+
+def load(port, rounds):
+    """Send the requests, return how many were answered."""
+    connection = connect(port)
+
+    def request(method, path, body=None, headers={}, status=200):
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == status, (method, path, response.status)
+
+    for number in range(ITEMS):
+        request("PUT", "%s/e%d.ics" % (COLLECTION, number),
+                EVENT % ("e%d" % number, number), status=201)
+    count = 0
+    for round in range(rounds):
+        for number in range(2):
+            name = "e%d.ics" % ((2 * round + number) % ITEMS)
+            request("GET", "%s/%s" % (COLLECTION, name))
+        request("PROPFIND", COLLECTION + "/", PROPFIND, {"Depth": "1"}, 207)
+        request("REPORT", COLLECTION + "/", MULTIGET, {}, 207)
+        request("GET", COLLECTION + "/")
+        count += 5
+    connection.close()
+    return count
+
+
+def main(rounds=100):
+    home = tempfile.mkdtemp(prefix="calypso-syscount-")
+    try:
+        shim = os.path.join(home, "syscount.so")
+        subprocess.check_call(["cc", "-shared", "-fPIC", "-o", shim,
+                               os.path.join(TESTS, "syscount.c"), "-ldl"])
+        directory = os.path.join(
+            home, ".config", "calypso", "calendars", COLLECTION.strip("/"))
+        os.makedirs(directory)
+        # Collections are the directories in git repositories
+        subprocess.check_call(["git", "init", "-q", directory])
+        subprocess.check_call(
+            ["git", "config", "user.name", "Calypso"], cwd=directory)
+        subprocess.check_call(
+            ["git", "config", "user.email", "calypso@localhost"],
+            cwd=directory)
+        output = os.path.join(home, "counts")
+        port = free_port()
+        environment = dict(os.environ, HOME=home, LD_PRELOAD=shim,
+                           SYSCOUNT_OUT=output)
+        log = open(os.path.join(home, "log"), "w")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(TOP, "calypso.py"), "-f",
+             "-H", "127.0.0.1", "-p", str(port)], env=environment,
+            stdout=log, stderr=subprocess.STDOUT,
+            # Stopped by SIGINT, even when run in the background
+            preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+        try:
+            started = time.time()
+            count = load(port, rounds)
+            elapsed = time.time() - started
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+        counts = [line.split() for line in open(output)]
+        counts = [dict(field.split("=") for field in line[1:])
+                  for line in counts if line[0] == str(server.pid)]
+        if not counts:
+            print "no counts reported by the server"
+            return 1
+        counts = dict((name, int(value)) for name, value in counts[0].items())
+        print "%d requests and %d PUT in %.2fs" % (count, ITEMS, elapsed)
+        print "send %(send)d, write %(write)d, sendfile %(sendfile)d" % counts
+        print "%d calls in all" % sum(counts.values())
+        return 0
+    finally:
+        shutil.rmtree(home, True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))